@@ -3,6 +3,9 @@ from typing import List, Optional
 from pydantic import BaseModel, Field
 
 from ai import llm
+from ai.json_stream import OnItem
+from ai.context import build_codebase
+from ai.prompt import render
 from tools.github import GithubFile
 from tools.jira import Issue
 from utils.state import Conversation
@@ -84,25 +87,28 @@ def write_pr(
     conversation: Conversation,
     repo_files: List[Optional[GithubFile]],
     # code_suggestion: str,
+    on_item: Optional[OnItem] = None,
 ):
     next = llm.stream_next(
         [
             {
                 "role": "system",
-                "content": SYSTEM_PROMPT.format(
-                    codebase="\n".join(str(f) for f in repo_files)
+                "content": render(
+                    SYSTEM_PROMPT,
+                    codebase=build_codebase(repo_files, query=str(ticket)),
                 ),
             },
             {
                 "role": "user",
-                "content": USER_PROMPT.format(
-                    ticket=ticket,
-                    codebase="\n".join(str(f) for f in repo_files),
+                "content": render(
+                    USER_PROMPT,
+                    ticket=str(ticket),
                     # suggestion=code_suggestion,
                 ),
             },
         ]
         + conversation,
         tools=TOOLS,
+        on_item=on_item,
     )
     return next
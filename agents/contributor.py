@@ -4,6 +4,9 @@ from pydantic import BaseModel, Field
 
 from agents.coder import File, SYSTEM_PROMPT
 from ai import llm
+from ai.json_stream import OnItem
+from ai.context import build_codebase
+from ai.prompt import render
 from tools.github import GithubFile, PullRequest
 from utils.state import Conversation
 
@@ -60,13 +63,16 @@ def next_action(
     conversation_context: Conversation,
     conversation: Conversation,
     repo_files: List[Optional[GithubFile]],
+    comment: str = "",
+    on_item: Optional[OnItem] = None,
 ):
     next = llm.stream_next(
         [
             {
                 "role": "system",
-                "content": SYSTEM_PROMPT.format(
-                    codebase="\n".join(str(f) for f in repo_files)
+                "content": render(
+                    SYSTEM_PROMPT,
+                    codebase=build_codebase(repo_files, query=comment),
                 ),
             }
         ]
@@ -74,5 +80,6 @@ def next_action(
         + [{"role": "user", "content": USER_INSTRUCTIONS}]
         + conversation,
         tools=TOOLS,
+        on_item=on_item,
     )
     return next
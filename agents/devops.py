@@ -3,6 +3,8 @@ from typing import List, Optional
 from pydantic import BaseModel, Field
 
 from ai import llm
+from ai.context import build_codebase
+from ai.prompt import first_user_message, render
 from tools.github import GithubFile
 from utils.state import Command, Conversation
 
@@ -53,10 +55,6 @@ docker
 gh
 ```
 
-### Commands that you have ran so far
-
-{commands}
-
 ### Instructions
 
 - The user doesn't have the ability to execute commands.
@@ -64,21 +62,27 @@ gh
 - If the command has the flags, run it in a non-interactive way. Otherwise, it might time out."""
 
 
+COMMANDS_PROMPT = """### Commands that you have ran so far
+
+{commands}"""
+
+
 def next_action(
     conversation: Conversation,
     repo: str,
     repo_files: List[Optional[GithubFile]],
     command_list: List[Command],
 ):
+    # Static prefix first so provider-side prompt caching hits across turns
     next = llm.stream_next(
         [
             {
                 "role": "system",
-                "content": PROMPT.format(
+                "content": render(
+                    PROMPT,
                     repo=repo,
-                    codebase="\n".join(str(f) for f in repo_files),
-                    commands="\n".join(
-                        [f"# {c.command}\n{c.output_str()}" for c in command_list]
+                    codebase=build_codebase(
+                        repo_files, query=first_user_message(conversation)
                     ),
                 ),
             },
@@ -87,7 +91,17 @@ def next_action(
                 "content": "Hi",
             },
         ]
-        + conversation,
+        + conversation
+        + [
+            {
+                "role": "system",
+                "content": COMMANDS_PROMPT.format(
+                    commands="\n".join(
+                        [f"# {c.command}\n{c.output_str()}" for c in command_list]
+                    ),
+                ),
+            },
+        ],
         tools=TOOLS,
     )
     return next
@@ -0,0 +1,113 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, List
+
+from tools.github import GithubFile
+
+
+INDEX_DIR = "db/index"
+MAX_BLOBS = 20_000
+# SQLite limits the number of parameters per statement
+BATCH = 500
+
+_connections: Dict[str, sqlite3.Connection] = {}
+lock = threading.Lock()
+
+
+class BlobCache:
+    # Values computed per blob sha, shared by every repo and persisted across runs.
+    # Only the requested shas are read, and only the missing ones are written.
+    def __init__(self, name: str, compute: Callable[[str], Any]):
+        self.name = name
+        self.compute = compute
+        self.entries: Dict[str, Any] = {}
+
+    def get(self, files: List[GithubFile]) -> List[Any]:
+        shas = [file_sha(f) for f in files]
+        unique = list(dict.fromkeys(shas))
+        now = time.time()
+        with lock:
+            connection = _connect()
+            stored = {sha for (sha,) in self._select(connection, "sha", unique)}
+            # Values already in memory aren't read again
+            unloaded = [sha for sha in stored if sha not in self.entries]
+            for sha, value in self._select(connection, "sha, value", unloaded):
+                self.entries[sha] = json.loads(value)
+
+            missing = {}
+            for file, sha in zip(files, shas):
+                if sha not in stored:
+                    if sha not in self.entries:
+                        self.entries[sha] = self.compute(file.content)
+                    missing[sha] = self.entries[sha]
+            connection.executemany(
+                "INSERT OR REPLACE INTO blobs VALUES (?, ?, ?, ?)",
+                [(self.name, sha, json.dumps(v), now) for sha, v in missing.items()],
+            )
+            # Blobs in use are the most recently used, so they are evicted last
+            connection.executemany(
+                "UPDATE blobs SET accessed = ? WHERE cache = ? AND sha = ?",
+                [(now, self.name, sha) for sha in stored],
+            )
+            if missing:
+                connection.execute(
+                    """DELETE FROM blobs WHERE cache = ? AND sha IN (
+                        SELECT sha FROM blobs WHERE cache = ?
+                        ORDER BY accessed DESC LIMIT -1 OFFSET ?
+                    )""",
+                    (self.name, self.name, MAX_BLOBS),
+                )
+            connection.commit()
+        return [self.entries[sha] for sha in shas]
+
+    def _select(
+        self, connection: sqlite3.Connection, columns: str, shas: List[str]
+    ) -> List[Any]:
+        rows = []
+        for i in range(0, len(shas), BATCH):
+            batch = shas[i : i + BATCH]
+            rows += connection.execute(
+                f"SELECT {columns} FROM blobs WHERE cache = ? "
+                f"AND sha IN ({','.join('?' * len(batch))})",
+                (self.name, *batch),
+            ).fetchall()
+        return rows
+
+    def __contains__(self, sha: str) -> bool:
+        with lock:
+            row = _connect().execute(
+                "SELECT 1 FROM blobs WHERE cache = ? AND sha = ?", (self.name, sha)
+            ).fetchone()
+        return row is not None
+
+
+def file_sha(file: GithubFile) -> str:
+    if file.sha:
+        return file.sha
+    return hashlib.sha1(file.content.encode()).hexdigest()
+
+
+def _connect() -> sqlite3.Connection:
+    path = f"{INDEX_DIR}/blobs.sqlite"
+    if path not in _connections:
+        os.makedirs(INDEX_DIR, exist_ok=True)
+        connection = sqlite3.connect(path, check_same_thread=False)
+        connection.execute(
+            """CREATE TABLE IF NOT EXISTS blobs (
+                cache TEXT NOT NULL,
+                sha TEXT NOT NULL,
+                value TEXT NOT NULL,
+                accessed REAL NOT NULL,
+                PRIMARY KEY (cache, sha)
+            )"""
+        )
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS blobs_accessed ON blobs (cache, accessed)"
+        )
+        connection.commit()
+        _connections[path] = connection
+    return _connections[path]
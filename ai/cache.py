@@ -0,0 +1,94 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from utils.io import print_system
+
+
+CACHE_PATH = "db/llm_cache.sqlite"
+CACHE_ENABLED = os.environ.get("LLM_CACHE", "True") == "True"
+MAX_BYTES = 512 * 1024 * 1024
+TTL = 7 * 24 * 60 * 60
+
+_connection: Optional[sqlite3.Connection] = None
+lock = threading.Lock()
+
+
+def key(**request: Any) -> str:
+    # Canonical form, so dict ordering and whitespace don't change the key
+    payload = json.dumps(request, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def get(cache_key: str) -> Optional[Dict[str, Any]]:
+    if not CACHE_ENABLED:
+        return None
+
+    now = time.time()
+    with lock:
+        connection = _connect()
+        row = connection.execute(
+            "SELECT value, created FROM responses WHERE key = ?", (cache_key,)
+        ).fetchone()
+        if not row:
+            return None
+        if row[1] + TTL < now:
+            connection.execute("DELETE FROM responses WHERE key = ?", (cache_key,))
+            connection.commit()
+            return None
+        connection.execute(
+            "UPDATE responses SET accessed = ? WHERE key = ?", (now, cache_key)
+        )
+        connection.commit()
+
+    print_system(f"(cached response {cache_key[:8]})")
+    return json.loads(row[0])
+
+
+def put(cache_key: str, value: Dict[str, Any]) -> None:
+    if not CACHE_ENABLED:
+        return
+
+    now = time.time()
+    payload = json.dumps(value)
+    with lock:
+        connection = _connect()
+        connection.execute(
+            "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+            (cache_key, payload, len(payload), now, now),
+        )
+        # Least recently used entries beyond the size budget are evicted
+        connection.execute(
+            """DELETE FROM responses WHERE key IN (
+                SELECT key FROM (
+                    SELECT key, SUM(size) OVER (ORDER BY accessed DESC) AS total
+                    FROM responses
+                ) WHERE total > ?
+            )""",
+            (MAX_BYTES,),
+        )
+        connection.execute("DELETE FROM responses WHERE created < ?", (now - TTL,))
+        connection.commit()
+
+
+def _connect() -> sqlite3.Connection:
+    global _connection
+
+    if _connection is None:
+        os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+        _connection = sqlite3.connect(CACHE_PATH, check_same_thread=False)
+        _connection.execute(
+            """CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created REAL NOT NULL,
+                accessed REAL NOT NULL
+            )"""
+        )
+        _connection.commit()
+    return _connection
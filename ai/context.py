@@ -0,0 +1,147 @@
+import ast
+import re
+from collections import OrderedDict, defaultdict
+from typing import Dict, List, Optional, Set, Tuple
+
+from ai.blob_cache import file_sha
+from ai.graph import get_graph
+from ai.index import get_index
+from tools.github import GithubFile
+
+
+CODEBASE_TOKENS = 30_000
+CHARS_PER_TOKEN = 4
+MAX_RENDERED = 16
+
+IDENTIFIER = re.compile(r"[A-Za-z_][A-Za-z0-9_]{2,}")
+STOPWORDS = {
+    "and",
+    "for",
+    "from",
+    "import",
+    "none",
+    "not",
+    "return",
+    "self",
+    "the",
+    "this",
+    "true",
+    "false",
+    "with",
+}
+
+# Returning the same string for the same inputs keeps prompt prefixes byte-stable
+_rendered: "OrderedDict[Tuple, str]" = OrderedDict()
+
+
+def build_codebase(
+    repo_files: List[Optional[GithubFile]],
+    query: str = "",
+    budget: int = CODEBASE_TOKENS,
+) -> str:
+    files = [f for f in repo_files if f]
+    key = (tuple((f.path, file_sha(f)) for f in files), query, budget)
+    if key in _rendered:
+        _rendered.move_to_end(key)
+        return _rendered[key]
+
+    _rendered[key] = _build_codebase(files, query, budget)
+    if len(_rendered) > MAX_RENDERED:
+        _rendered.popitem(last=False)
+    return _rendered[key]
+
+
+def _build_codebase(files: List[GithubFile], query: str, budget: int) -> str:
+    codebase = "\n".join(str(f) for f in files)
+    if _tokens(codebase) <= budget:
+        return codebase
+
+    scores = rank(files, query)
+    ranked = sorted(files, key=lambda f: scores[f.path], reverse=True)
+
+    # Top-ranked files go in full first. The rest get stubs, or just their paths,
+    # while the budget lasts. Each section costs its length plus a line break.
+    sections: Dict[str, str] = {}
+    remaining = budget * CHARS_PER_TOKEN
+    for file in ranked:
+        full = str(file)
+        if len(full) < remaining:
+            sections[file.path] = full
+            remaining -= len(full) + 1
+    for file in ranked:
+        if file.path in sections:
+            continue
+        for section in [_stub(file), file.path]:
+            if len(section) < remaining:
+                sections[file.path] = section
+                remaining -= len(section) + 1
+                break
+        else:
+            break
+    return "\n".join(sections[f.path] for f in ranked if f.path in sections)
+
+
+def rank(files: List[GithubFile], query: str) -> Dict[str, float]:
+    terms = _terms(query)
+    scores: Dict[str, float] = defaultdict(float)
+    scores.update(get_index(files).scores(query))
+    for file in files:
+        if file.path in query:
+            # Explicit mentions, e.g. tracebacks or review comments
+            scores[file.path] += 10
+        *dirs, name = file.path.lower().split("/")
+        if name.rsplit(".", 1)[0] in terms:
+            scores[file.path] += 3
+        scores[file.path] += sum(1 for d in dirs if d in terms)
+
+    # Files around tracebacks, mentioned paths and symbols, by import distance
+    graph = get_graph(files)
+    mentioned = [f.path for f in files if f.path in query]
+    for path, distance in graph.related(query, seeds=mentioned).items():
+        scores[path] += 5 / (distance + 1)
+
+    # Files imported by relevant files are likely relevant too
+    boosts: Dict[str, float] = defaultdict(float)
+    for file in files:
+        if scores[file.path] <= 0:
+            continue
+        for imported in graph.imports[file.path]:
+            boosts[imported] = max(boosts[imported], scores[file.path] / 2)
+    for path, boost in boosts.items():
+        scores[path] += boost
+    return scores
+
+
+def _terms(text: str) -> Set[str]:
+    return {t.lower() for t in IDENTIFIER.findall(text)} - STOPWORDS
+
+
+def _tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN
+
+
+def _stub(file: GithubFile) -> str:
+    signatures = []
+    if file.path.endswith(".py"):
+        try:
+            tree = ast.parse(file.content)
+        except SyntaxError:
+            tree = None
+        if tree:
+            lines = file.content.splitlines()
+            signatures = _signatures(tree.body, lines)
+    signatures.append("# ... (contents omitted)")
+    stub = "\n".join(signatures)
+    return f"{file.path}\n```\n{stub}\n```"
+
+
+def _signatures(nodes: List[ast.stmt], lines: List[str]) -> List[str]:
+    signatures = []
+    for node in nodes:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            # The header spans from the def line up to the first body statement
+            end = node.body[0].lineno - 1
+            signatures.extend(lines[node.lineno - 1 : max(end, node.lineno)])
+            if isinstance(node, ast.ClassDef):
+                signatures.extend(_signatures(node.body, lines))
+    return signatures
@@ -0,0 +1,161 @@
+import ast
+import re
+from collections import defaultdict, deque
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from ai.blob_cache import BlobCache, file_sha
+from tools.github import GithubFile
+
+
+# Names that look like code: calls, definitions, snake_case and CamelCase
+SYMBOL = re.compile(
+    r"\b([A-Za-z_]\w*)\(|\b(?:def|class) (\w+)|\b(\w*_\w*|[A-Z][a-z0-9]+[A-Z]\w*)\b"
+)
+# `File "app/main.py", line 3` from tracebacks and `app/main.py:3:` from pytest
+TRACEBACK_PATH = re.compile(r'File "([^"]+\.py)", line \d+|([\w./-]+\.py):\d+')
+
+_last_graph: Optional["Graph"] = None
+
+
+class Graph:
+    def __init__(self, files: List[GithubFile], summaries: List[Dict[str, Any]]):
+        self.files = files
+        self.summaries = summaries
+        self.paths = {f.path for f in files}
+        self.modules = {_module(f.path): f.path for f in files}
+        self.imports: Dict[str, Set[str]] = defaultdict(set)
+        self.importers: Dict[str, Set[str]] = defaultdict(set)
+        self.definitions: Dict[str, Set[str]] = defaultdict(set)
+        self.references: Dict[str, Set[str]] = defaultdict(set)
+
+        for file, summary in zip(files, summaries):
+            for module, level, names in summary["imports"]:
+                for imported in self._resolve(file.path, module, level, names):
+                    if imported != file.path:
+                        self.imports[file.path].add(imported)
+                        self.importers[imported].add(file.path)
+            for name in summary["defs"]:
+                self.definitions[name].add(file.path)
+            for name in summary["refs"]:
+                self.references[name].add(file.path)
+
+    def with_files(self, files: List[GithubFile]) -> "Graph":
+        # A throwaway copy with files added or replaced, e.g. by a PR that may never
+        # be merged, so their summaries aren't cached
+        paths = {f.path for f in files}
+        pairs = [
+            (f, s) for f, s in zip(self.files, self.summaries) if f.path not in paths
+        ]
+        pairs += [(f, summarize(f.content)) for f in files if f.path.endswith(".py")]
+        return Graph([f for f, _ in pairs], [s for _, s in pairs])
+
+    def neighborhood(self, seeds: Iterable[str], depth: int = 2) -> Dict[str, int]:
+        distances = {s: 0 for s in seeds if s in self.paths}
+        queue = deque(distances)
+        while queue:
+            path = queue.popleft()
+            if distances[path] >= depth:
+                continue
+            for neighbor in self.imports[path] | self.importers[path]:
+                if neighbor not in distances:
+                    distances[neighbor] = distances[path] + 1
+                    queue.append(neighbor)
+        return distances
+
+    def dependents(self, paths: Iterable[str]) -> Set[str]:
+        # The paths plus every file that imports them, directly or transitively
+        seen = {p for p in paths if p in self.paths}
+        queue = deque(seen)
+        while queue:
+            for importer in self.importers[queue.popleft()]:
+                if importer not in seen:
+                    seen.add(importer)
+                    queue.append(importer)
+        return seen
+
+    def related(
+        self, text: str, seeds: Iterable[str] = (), depth: int = 2
+    ) -> Dict[str, int]:
+        seeds = set(seeds) | set(self.traceback_paths(text))
+        # Symbols mentioned in the text, e.g. in a diff hunk, seed their definitions
+        for name in {"".join(m) for m in SYMBOL.findall(text)}:
+            if len(self.definitions.get(name, ())) == 1:
+                seeds.update(self.definitions[name])
+        return self.neighborhood(seeds, depth=depth)
+
+    def traceback_paths(self, text: str) -> List[str]:
+        paths = []
+        for match in TRACEBACK_PATH.finditer(text):
+            path = match.group(1) or match.group(2)
+            # Container paths are absolute, repo paths are relative
+            for candidate in self.paths:
+                if path == candidate or path.endswith(f"/{candidate}"):
+                    paths.append(candidate)
+        return paths
+
+    def _resolve(
+        self, path: str, module: Optional[str], level: int, names: List[str]
+    ) -> List[str]:
+        if level:
+            package = _module(path).split(".")
+            if not path.endswith("__init__.py"):
+                package = package[:-1]
+            package = package[: len(package) - level + 1]
+            module = ".".join(package + ([module] if module else []))
+        if not module:
+            return []
+
+        resolved = []
+        for name in names:
+            # `from package import module` imports a module, not a symbol
+            if f"{module}.{name}" in self.modules:
+                resolved.append(self.modules[f"{module}.{name}"])
+        if module in self.modules:
+            resolved.append(self.modules[module])
+        return resolved
+
+
+def get_graph(repo_files: List[Optional[GithubFile]]) -> Graph:
+    global _last_graph
+
+    files = [f for f in repo_files if f and f.path.endswith(".py")]
+    keys = [(f.path, file_sha(f)) for f in files]
+    if _last_graph and [(f.path, file_sha(f)) for f in _last_graph.files] == keys:
+        return _last_graph
+
+    _last_graph = Graph(files, _modules.get(files))
+    return _last_graph
+
+
+def summarize(content: str) -> Dict[str, Any]:
+    imports: List[Tuple[Optional[str], int, List[str]]] = []
+    defs: Set[str] = set()
+    refs: Set[str] = set()
+    try:
+        tree = ast.parse(content)
+    except SyntaxError:
+        return {"imports": imports, "defs": [], "refs": []}
+
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            imports.extend((a.name, 0, []) for a in node.names)
+        elif isinstance(node, ast.ImportFrom):
+            imports.append((node.module, node.level, [a.name for a in node.names]))
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            defs.add(node.name)
+        elif isinstance(node, ast.Name):
+            refs.add(node.id)
+        elif isinstance(node, ast.Attribute):
+            refs.add(node.attr)
+    return {"imports": imports, "defs": sorted(defs), "refs": sorted(refs - defs)}
+
+
+# Parsed module summaries per blob sha
+_modules = BlobCache("graph", summarize)
+
+
+def _module(path: str) -> str:
+    module = path[: -len(".py")].replace("/", ".")
+    if module.endswith(".__init__"):
+        module = module[: -len(".__init__")]
+    return module
@@ -0,0 +1,97 @@
+import math
+import re
+from collections import Counter, defaultdict
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+from ai.blob_cache import BlobCache, file_sha
+from tools.github import GithubFile
+
+
+K1 = 1.5
+B = 0.75
+
+IDENTIFIER = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+WORD = re.compile(r"[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|[0-9]+")
+
+_last_index: Optional["Index"] = None
+
+
+class Index:
+    def __init__(self, files: List[GithubFile], term_counts: List[Dict[str, int]]):
+        self.files = files
+        self.lengths = [sum(c.values()) for c in term_counts]
+        self.avg_length = sum(self.lengths) / max(len(self.lengths), 1)
+        self.postings: Dict[str, List[Tuple[int, int]]] = defaultdict(list)
+        for doc, counts in enumerate(term_counts):
+            for term, count in counts.items():
+                self.postings[term].append((doc, count))
+
+    def scores(self, query: str) -> Dict[str, float]:
+        scores: Dict[str, float] = defaultdict(float)
+        n = len(self.files)
+        for term in tokenize(query):
+            postings = self.postings.get(term, [])
+            if not postings:
+                continue
+            idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc, count in postings:
+                norm = K1 * (1 - B + B * self.lengths[doc] / self.avg_length)
+                scores[self.files[doc].path] += idf * count * (K1 + 1) / (count + norm)
+        return scores
+
+    def search(self, query: str, k: int = 10) -> List[GithubFile]:
+        scores = self.scores(query)
+        ranked = sorted(self.files, key=lambda f: scores[f.path], reverse=True)
+        return [f for f in ranked[:k] if scores[f.path] > 0]
+
+
+def get_index(repo_files: List[Optional[GithubFile]]) -> Index:
+    global _last_index
+
+    files = [f for f in repo_files if f]
+    if _last_index and _keys(_last_index.files) == _keys(files):
+        return _last_index
+
+    counts = _term_counts.get(files)
+
+    # Paths are not part of the blob, so their terms are added per document
+    term_counts = []
+    for file, blob_counts in zip(files, counts):
+        file_counts = dict(blob_counts)
+        for term, count in tokenize(file.path).items():
+            file_counts[term] = file_counts.get(term, 0) + count
+        term_counts.append(file_counts)
+    _last_index = Index(files, term_counts)
+    return _last_index
+
+
+def search(
+    repo_files: List[Optional[GithubFile]], query: str, k: int = 10
+) -> List[GithubFile]:
+    return get_index(repo_files).search(query, k=k)
+
+
+def tokenize(text: str) -> Counter:
+    counts: Counter = Counter()
+    # Identifiers repeat a lot, so each distinct one is only split once
+    for identifier, count in Counter(IDENTIFIER.findall(text)).items():
+        for term in _split(identifier):
+            counts[term] += count
+    return counts
+
+
+@lru_cache(maxsize=100_000)
+def _split(identifier: str) -> Tuple[str, ...]:
+    words = [w.lower() for w in WORD.findall(identifier) if len(w) > 1]
+    if len(words) > 1:
+        words.append(identifier.lower())
+    return tuple(words)
+
+
+# Term counts per blob sha
+_term_counts = BlobCache("terms", tokenize)
+
+
+def _keys(files: List[GithubFile]) -> List[Tuple[str, str]]:
+    return [(f.path, file_sha(f)) for f in files]
@@ -0,0 +1,189 @@
+import json
+import re
+from typing import Any, Callable, List, Optional, Tuple, Union
+
+
+Path = Tuple[Union[str, int], ...]
+OnItem = Callable[[Path, Any], None]
+
+VALUE = "VALUE"
+FIRST_VALUE = "FIRST_VALUE"
+KEY = "KEY"
+FIRST_KEY = "FIRST_KEY"
+COLON = "COLON"
+STRING = "STRING"
+LITERAL = "LITERAL"
+AFTER_VALUE = "AFTER_VALUE"
+END = "END"
+
+WHITESPACE = " \t\r\n"
+STRING_SPECIAL = re.compile(r'["\\]')
+ESCAPES = {
+    '"': '"',
+    "\\": "\\",
+    "/": "/",
+    "b": "\b",
+    "f": "\f",
+    "n": "\n",
+    "r": "\r",
+    "t": "\t",
+    # Models escape single quotes, which isn't valid JSON. Keep them as written.
+    "'": "\\'",
+}
+
+
+class ArgumentParser:
+    def __init__(self, on_item: Optional[OnItem] = None):
+        self.on_item = on_item
+        # One [container, key] frame per open object or array
+        self.stack: List[List[Any]] = []
+        self.state = VALUE
+        self.is_key = False
+        self.chunks: List[str] = []
+        self.escape: Optional[str] = None
+        self.surrogates = False
+        self.result: Any = None
+
+    def feed(self, delta: str) -> None:
+        i = 0
+        n = len(delta)
+        while i < n:
+            if self.state == STRING:
+                i = self._feed_string(delta, i)
+                continue
+
+            c = delta[i]
+            if self.state == LITERAL:
+                if c in WHITESPACE or c in ",]}":
+                    self._value(json.loads("".join(self.chunks)))
+                    self.chunks = []
+                    continue
+                self.chunks.append(c)
+            elif c in WHITESPACE:
+                pass
+            elif self.state in [VALUE, FIRST_VALUE]:
+                if c == "]" and self.state == FIRST_VALUE:
+                    self._close()
+                elif c == "{":
+                    self.stack.append([{}, None])
+                    self.state = FIRST_KEY
+                elif c == "[":
+                    self.stack.append([[], 0])
+                    self.state = FIRST_VALUE
+                elif c == '"':
+                    self.state = STRING
+                    self.is_key = False
+                else:
+                    self.state = LITERAL
+                    self.chunks.append(c)
+            elif self.state in [KEY, FIRST_KEY]:
+                if c == "}" and self.state == FIRST_KEY:
+                    self._close()
+                elif c == '"':
+                    self.state = STRING
+                    self.is_key = True
+                else:
+                    raise ValueError(f"Expected a key, found {c!r}")
+            elif self.state == COLON:
+                if c != ":":
+                    raise ValueError(f"Expected ':', found {c!r}")
+                self.state = VALUE
+            elif self.state == AFTER_VALUE:
+                if c == ",":
+                    self.state = KEY if isinstance(self.stack[-1][0], dict) else VALUE
+                elif c in "]}":
+                    self._close()
+                else:
+                    raise ValueError(f"Expected ',' or a closing bracket, found {c!r}")
+            else:
+                raise ValueError(f"Unexpected {c!r} after the end of the arguments")
+            i += 1
+
+    def close(self) -> Any:
+        if self.state == LITERAL:
+            self._value(json.loads("".join(self.chunks)))
+        if self.state != END:
+            raise ValueError("Incomplete tool arguments")
+        return self.result
+
+    def _feed_string(self, delta: str, i: int) -> int:
+        if self.escape is not None:
+            # Unicode escapes can be split across deltas
+            self.escape += delta[i]
+            if self.escape[0] == "u":
+                if len(self.escape) == 5:
+                    code = int(self.escape[1:], 16)
+                    self.surrogates = self.surrogates or 0xD800 <= code <= 0xDFFF
+                    self.chunks.append(chr(code))
+                    self.escape = None
+            elif self.escape in ESCAPES:
+                self.chunks.append(ESCAPES[self.escape])
+                self.escape = None
+            else:
+                raise ValueError(f"Invalid escape {self.escape!r}")
+            return i + 1
+
+        match = STRING_SPECIAL.search(delta, i)
+        if not match:
+            self.chunks.append(delta[i:])
+            return len(delta)
+
+        j = match.start()
+        if j > i:
+            self.chunks.append(delta[i:j])
+        if delta[j] == "\\":
+            self.escape = ""
+            return j + 1
+
+        value = "".join(self.chunks)
+        self.chunks = []
+        if self.surrogates:
+            # Characters outside the BMP are escaped as surrogate pairs
+            value = value.encode("utf-16", "surrogatepass").decode("utf-16")
+            self.surrogates = False
+        if self.is_key:
+            self.stack[-1][1] = value
+            self.state = COLON
+        else:
+            self._value(value)
+        return j + 1
+
+    def _value(self, value: Any) -> None:
+        if not self.stack:
+            self.result = value
+            self.state = END
+            return
+
+        container, key = self.stack[-1]
+        if isinstance(container, list):
+            container.append(value)
+            self.stack[-1][1] = key + 1
+            if self.on_item:
+                self.on_item(self._path() + (key,), value)
+        else:
+            container[key] = value
+        self.state = AFTER_VALUE
+
+    def _close(self) -> None:
+        container, _ = self.stack.pop()
+        self._value(container)
+
+    def _path(self) -> Path:
+        # Keys of the open containers, up to the innermost one
+        return tuple(key for _, key in self.stack[:-1])
+
+
+def parse(arguments: str) -> Any:
+    parser = ArgumentParser()
+    parser.feed(arguments)
+    return parser.close()
+
+
+def replay(value: Any, on_item: OnItem, path: Path = ()) -> None:
+    if isinstance(value, dict):
+        for key, item in value.items():
+            replay(item, on_item, path + (key,))
+    elif isinstance(value, list):
+        for index, item in enumerate(value):
+            replay(item, on_item, path + (index,))
+            on_item(path + (index,), item)
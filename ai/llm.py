@@ -1,9 +1,12 @@
-from typing import Any, Dict, List, Optional, Union
+from typing import Any, Awaitable, Dict, Iterable, List, Optional, TypeVar, Union
 
-import json
+import asyncio
+import weakref
 from pydantic import BaseModel
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
 
+from ai import cache
+from ai.json_stream import ArgumentParser, OnItem, replay
 from utils.io import print_assistant
 
 
@@ -19,6 +22,14 @@ client = OpenAI()
 MODEL = "gpt-4-turbo"
 TEMPERATURE = 0.0
 
+MAX_CONCURRENCY = 8
+
+T = TypeVar("T")
+
+# Pooled connections can't be shared across event loops
+_async_clients: "weakref.WeakKeyDictionary[Any, AsyncOpenAI]"
+_async_clients = weakref.WeakKeyDictionary()
+
 
 def call(
     messages: List[Dict[str, str]],
@@ -71,7 +82,13 @@ def stream_next(
     stop: Optional[str] = None,
     tools: Optional[List] = None,
     tool_choice="auto",
+    on_item: Optional[OnItem] = None,
 ) -> Union[str, RawTool]:
+    cache_key = _cache_key(messages, model, temperature, stop, tools, tool_choice)
+    cached = _from_cache(cache_key, on_item)
+    if cached is not None:
+        return cached
+
     response = call(
         messages,
         model,
@@ -82,70 +99,205 @@ def stream_next(
         tool_choice=tool_choice,
     )
 
-    first_chunk = next(response)
-    while (
-        first_chunk.choices[0].delta.content is None
-        and first_chunk.choices[0].delta.tool_calls is None
-    ):
-        first_chunk = next(response)
-
-    if first_chunk.choices[0].delta.content is not None:
-        return stream_text(first_chunk, response)
-    return collect_tool(first_chunk, response)
+    collector = _Collector(on_item)
+    for chunk in response:
+        collector.add(chunk)
+    result = collector.result()
+    _to_cache(cache_key, result)
+    return result
 
 
-def stream_text(first_chunk, response) -> str:
-    message = first_chunk.choices[0].delta.content
-    print_assistant(first_chunk.choices[0].delta.content, end="", flush=True)
-    for chunk in response:
-        if chunk.choices[0].delta.content is not None:
-            message += chunk.choices[0].delta.content
-            print_assistant(chunk.choices[0].delta.content, end="", flush=True)
-    print_assistant()
-    return message
+class _Collector:
+    # Chunk handling shared by the sync and async streams. Chunks before the first
+    # content or tool call are skipped.
+    def __init__(self, on_item: Optional[OnItem] = None):
+        self.on_item = on_item
+        self.message: Optional[str] = None
+        self.tool_id: Optional[str] = None
+        self.tool_name = ""
+        self.parser = ArgumentParser(on_item)
+        self.args: List[Dict[str, Any]] = []
+        self.current_index = 0
 
+    def add(self, chunk) -> None:
+        delta = chunk.choices[0].delta
+        if self.message is None and self.tool_id is None:
+            if delta.content is not None:
+                self.message = ""
+            elif delta.tool_calls is not None:
+                self.tool_id = delta.tool_calls[0].id
+                self.tool_name = delta.tool_calls[0].function.name
+                # Arguments are parsed as they arrive, so completed items can be
+                # used early
+                self.parser.feed(delta.tool_calls[0].function.arguments or "")
+                print_assistant(".", end="", flush=True)
+                return
+            else:
+                return
 
-def collect_tool(first_chunk, response) -> RawTool:
-    tool_id = first_chunk.choices[0].delta.tool_calls[0].id
-    tool_name = first_chunk.choices[0].delta.tool_calls[0].function.name
-    arguments = first_chunk.choices[0].delta.tool_calls[0].function.arguments
-    print_assistant(".", end="", flush=True)
+        if self.message is not None:
+            if delta.content is not None:
+                self.message += delta.content
+                print_assistant(delta.content, end="", flush=True)
+            return
 
-    args = []
-    current_index = 0
-    for chunk in response:
-        if chunk.choices[0].delta.tool_calls:
-            if chunk.choices[0].delta.tool_calls[0].index != current_index:
-                arguments = arguments.replace(r"\\'", "<ESCAPED_QUOTE>").replace(
-                    r"\'", "<ESCAPED_QUOTE>"
-                )
-                arg_dict = json.loads(arguments)
-                arg_dict = unesacape_str(arg_dict)
-                args.append(arg_dict)
+        if delta.tool_calls:
+            if delta.tool_calls[0].index != self.current_index:
+                self.args.append(self.parser.close())
 
-                current_index = chunk.choices[0].delta.tool_calls[0].index
-                arguments = ""
+                self.current_index = delta.tool_calls[0].index
+                self.parser = ArgumentParser(self.on_item)
 
-            arguments += chunk.choices[0].delta.tool_calls[0].function.arguments
+            self.parser.feed(delta.tool_calls[0].function.arguments)
 
         print_assistant(".", end="", flush=True)
-    arguments = arguments.replace(r"\\'", "<ESCAPED_QUOTE>").replace(
-        r"\'", "<ESCAPED_QUOTE>"
+
+    def result(self) -> Union[str, RawTool]:
+        if self.message is None and self.tool_id is None:
+            raise ValueError("The response has no content or tool calls")
+        print_assistant()
+        if self.message is not None:
+            return self.message
+        assert self.tool_id
+        self.args.append(self.parser.close())
+        return RawTool(id=self.tool_id, name=self.tool_name, arguments=self.args)
+
+
+def _cache_key(
+    messages: List[Dict[str, str]],
+    model: Optional[str],
+    temperature: Optional[float],
+    stop: Optional[str],
+    tools: Optional[List],
+    tool_choice,
+) -> Optional[str]:
+    if temperature is None:
+        temperature = TEMPERATURE
+    # Only deterministic requests can be replayed
+    if temperature != 0.0:
+        return None
+    return cache.key(
+        messages=messages,
+        model=model or MODEL,
+        stop=stop,
+        tools=tools,
+        tool_choice=tool_choice if tools is not None else None,
+    )
+
+
+def _from_cache(
+    cache_key: Optional[str], on_item: Optional[OnItem] = None
+) -> Optional[Union[str, RawTool]]:
+    if not cache_key:
+        return None
+    value = cache.get(cache_key)
+    if value is None:
+        return None
+    if "tool" in value:
+        tool = RawTool.model_validate(value["tool"])
+        if on_item:
+            for arguments in tool.arguments:
+                replay(arguments, on_item)
+        return tool
+    print_assistant(value["text"])
+    return value["text"]
+
+
+def _to_cache(cache_key: Optional[str], result: Union[str, RawTool]) -> None:
+    if not cache_key:
+        return
+    if isinstance(result, RawTool):
+        cache.put(cache_key, {"tool": result.model_dump()})
+    else:
+        cache.put(cache_key, {"text": result})
+
+
+def _async_client() -> AsyncOpenAI:
+    loop = asyncio.get_running_loop()
+    if loop not in _async_clients:
+        # The SDK's default http client keeps a pool of connections alive
+        _async_clients[loop] = AsyncOpenAI()
+    return _async_clients[loop]
+
+
+async def acall(
+    messages: List[Dict[str, str]],
+    model: Optional[str] = None,
+    temperature: Optional[float] = None,
+    stop: Optional[str] = None,
+    stream: bool = False,
+    tools: Optional[List] = None,
+    tool_choice="auto",
+):
+    if not model:
+        model = MODEL
+    if temperature is None:
+        temperature = TEMPERATURE
+
+    if tools is not None:
+        return await _async_client().chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            stop=stop,
+            stream=stream,
+            tools=tools,
+            tool_choice=tool_choice,
+        )
+    return await _async_client().chat.completions.create(
+        model=model,
+        messages=messages,
+        temperature=temperature,
+        stop=stop,
+        stream=stream,
     )
-    arg_dict = json.loads(arguments)
-    arg_dict = unesacape_str(arg_dict)
-    args.append(arg_dict)
 
-    print_assistant()
 
-    return RawTool(id=tool_id, name=tool_name, arguments=args)
+async def astream_next(
+    messages: List[Dict[str, str]],
+    model: Optional[str] = None,
+    temperature: Optional[float] = None,
+    stop: Optional[str] = None,
+    tools: Optional[List] = None,
+    tool_choice="auto",
+    on_item: Optional[OnItem] = None,
+) -> Union[str, RawTool]:
+    cache_key = _cache_key(messages, model, temperature, stop, tools, tool_choice)
+    cached = _from_cache(cache_key, on_item)
+    if cached is not None:
+        return cached
+
+    response = await acall(
+        messages,
+        model,
+        temperature,
+        stop,
+        stream=True,
+        tools=tools,
+        tool_choice=tool_choice,
+    )
+
+    collector = _Collector(on_item)
+    async for chunk in response:
+        collector.add(chunk)
+    result = collector.result()
+    _to_cache(cache_key, result)
+    return result
+
+
+async def gather(
+    calls: Iterable[Awaitable[T]], limit: int = MAX_CONCURRENCY
+) -> List[T]:
+    semaphore = asyncio.Semaphore(limit)
+
+    async def _limited(call: Awaitable[T]) -> T:
+        async with semaphore:
+            return await call
+
+    return await asyncio.gather(*(_limited(c) for c in calls))
 
 
-def unesacape_str(val) -> Any:
-    if isinstance(val, str):
-        return val.replace("<ESCAPED_QUOTE>", "\\'")
-    if isinstance(val, List):
-        return [unesacape_str(v) for v in val]
-    if isinstance(val, Dict):
-        return {k: unesacape_str(v) for k, v in val.items()}
-    return val
+def run_concurrently(
+    calls: Iterable[Awaitable[T]], limit: int = MAX_CONCURRENCY
+) -> List[T]:
+    return asyncio.run(gather(calls, limit=limit))
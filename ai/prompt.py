@@ -0,0 +1,15 @@
+from functools import lru_cache
+from typing import Dict, List
+
+
+@lru_cache(maxsize=32)
+def render(template: str, **kwargs: str) -> str:
+    # Agents re-render the same megabyte-sized system prompts on every turn
+    return template.format(**kwargs)
+
+
+def first_user_message(conversation: List[Dict]) -> str:
+    for message in conversation:
+        if message["role"] == "user" and message["content"]:
+            return message["content"]
+    return ""
@@ -0,0 +1,59 @@
+import os
+from unittest import TestCase
+from unittest.mock import patch
+
+os.environ.setdefault("GITHUB_TOKEN", "test")
+
+from ai.context import CHARS_PER_TOKEN, _build_codebase, _stub, _tokens
+from tools.github import GithubFile
+
+
+def module(i: int) -> GithubFile:
+    # Bodies are longer than signatures, so stubs are much smaller than files
+    body = "".join(f"    argument += {k}\n" for k in range(5))
+    functions = "\n".join(
+        f"def function_{i}_{j}(argument):\n{body}    return argument\n"
+        for j in range(50)
+    )
+    return GithubFile(path=f"app/module_{i}.py", content=functions)
+
+
+FILES = [module(i) for i in range(100)]
+TOP = FILES[42]
+
+
+def fits(*sections: str) -> int:
+    # The smallest budget that fits the sections, each with a line break
+    return sum(len(s) + 1 for s in sections) // CHARS_PER_TOKEN + 1
+
+
+class BuildCodebaseTests(TestCase):
+    def build(self, budget: int) -> str:
+        scores = {f.path: 1.0 for f in FILES}
+        scores[TOP.path] = 10.0
+        with patch("ai.context.rank", return_value=scores):
+            return _build_codebase(FILES, f'File "{TOP.path}", line 3', budget)
+
+    def test_stays_within_budget(self):
+        for budget in [0, 5, 500, 5_000, 30_000]:
+            self.assertLessEqual(_tokens(self.build(budget)), budget)
+
+    def test_top_file_first_in_full(self):
+        codebase = self.build(30_000)
+        self.assertTrue(codebase.startswith(f"{TOP}\n"))
+
+    def test_stubs_after_full_files(self):
+        budget = fits(str(TOP), _stub(FILES[0]), _stub(FILES[1]))
+        codebase = self.build(budget)
+        self.assertTrue(codebase.startswith(f"{TOP}\n"))
+        self.assertTrue(codebase.endswith(f"\n{_stub(FILES[0])}\n{_stub(FILES[1])}"))
+
+    def test_paths_when_stubs_dont_fit(self):
+        codebase = self.build(fits(str(TOP), FILES[0].path, FILES[1].path))
+        self.assertTrue(codebase.startswith(f"{TOP}\n"))
+        self.assertTrue(codebase.endswith("\napp/module_0.py\napp/module_1.py"))
+        self.assertNotIn("contents omitted", codebase)
+
+    def test_under_budget(self):
+        codebase = _build_codebase(FILES[:2], "", 100_000)
+        self.assertEqual(codebase, f"{FILES[0]}\n{FILES[1]}")
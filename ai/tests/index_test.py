@@ -0,0 +1,86 @@
+import os
+import tempfile
+from typing import Set
+from unittest import TestCase
+from unittest.mock import patch
+
+os.environ.setdefault("GITHUB_TOKEN", "test")
+
+from ai import blob_cache, index
+from tools.github import GithubFile
+
+
+FILES = [
+    GithubFile(path="app/parser.py", content="def parse(text):\n    return tokens\n"),
+    GithubFile(
+        path="app/server.py",
+        content="def serve(request):\n    handler = get_handler(request)\n"
+        "    return handler(request)\n",
+    ),
+    GithubFile(
+        path="app/utils.py", content="def get_handler(name):\n    return name\n"
+    ),
+]
+
+
+def stored() -> Set[str]:
+    rows = blob_cache._connect().execute("SELECT sha FROM blobs WHERE cache = 'terms'")
+    return {sha for (sha,) in rows}
+
+
+def other_file(i: int) -> GithubFile:
+    return GithubFile(path=f"other/file_{i}.py", content=f"other_{i} = {i}")
+
+
+class IndexTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        for module, name, value in [
+            (blob_cache, "INDEX_DIR", directory.name),
+            (index, "_term_counts", blob_cache.BlobCache("terms", index.tokenize)),
+            (index, "_last_index", None),
+        ]:
+            patcher = patch.object(module, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_tokenize(self):
+        counts = index.tokenize("getHandler(get_handler) HTTPServer")
+        self.assertEqual(counts["handler"], 2)
+        self.assertEqual(counts["gethandler"], 1)
+        self.assertEqual(counts["server"], 1)
+
+    def test_bm25_ranking(self):
+        results = index.search(FILES, "request handler")
+        self.assertEqual([f.path for f in results], ["app/server.py", "app/utils.py"])
+        # Rare terms weigh more than common ones
+        scores = index.get_index(FILES).scores("parse handler")
+        self.assertGreater(scores["app/parser.py"], scores["app/utils.py"])
+
+    def test_path_terms(self):
+        results = index.search(FILES, "utils")
+        self.assertEqual([f.path for f in results], ["app/utils.py"])
+
+    def test_eviction_keeps_blobs_in_use(self):
+        other = [other_file(i) for i in range(5)]
+        new = GithubFile(path="app/new.py", content="def new(): pass")
+        with patch.object(blob_cache, "MAX_BLOBS", 5):
+            index.get_index(FILES)
+            index.get_index(other)
+            # FILES were evicted by other, but the new file and FILES are in use
+            results = index.search(FILES + [new], "request")
+            self.assertEqual(results[0].path, "app/server.py")
+            self.assertLessEqual(len(stored()), 5)
+            for file in FILES + [new]:
+                self.assertIn(blob_cache.file_sha(file), stored())
+
+    def test_eviction_least_recently_used(self):
+        other = [other_file(i) for i in range(3)]
+        with patch.object(blob_cache, "MAX_BLOBS", 5):
+            index.get_index(FILES)
+            index.get_index(other[:2])
+            index.get_index(FILES[:1])  # Cache hit
+            index.get_index(other[2:])
+            self.assertIn(blob_cache.file_sha(FILES[0]), stored())
+            self.assertNotIn(blob_cache.file_sha(FILES[1]), stored())
@@ -0,0 +1,60 @@
+import json
+from unittest import TestCase
+
+from ai.json_stream import ArgumentParser, parse, replay
+
+
+ARGUMENTS = {
+    "title": "Add \"quotes\", unicode é \U0001F600 and \\ slashes",
+    "files": [
+        {"path": "app/main.py", "content": "print('hi')\n\tx = [1, 2]\n"},
+        {"path": "app/empty.py", "content": ""},
+    ],
+    "test_files": [],
+    "deleted_files": ["old.py"],
+    "draft": False,
+    "count": -1.5e3,
+    "parent": None,
+}
+
+
+class ArgumentParserTests(TestCase):
+    def test_chunked(self):
+        for arguments in [
+            json.dumps(ARGUMENTS),
+            json.dumps(ARGUMENTS, indent=2, ensure_ascii=False),
+        ]:
+            for size in [1, 2, 3, 7, len(arguments)]:
+                parser = ArgumentParser()
+                for i in range(0, len(arguments), size):
+                    parser.feed(arguments[i : i + size])
+                assert parser.close() == ARGUMENTS
+
+    def test_items(self):
+        items = []
+        parser = ArgumentParser(on_item=lambda path, value: items.append(path))
+        arguments = json.dumps(ARGUMENTS)
+        for i in range(0, len(arguments), 5):
+            parser.feed(arguments[i : i + 5])
+            if "app/empty.py" in arguments[: i + 5]:
+                # The first file is complete before the stream ends
+                assert ("files", 0) in items
+        parser.close()
+        assert items == [("files", 0), ("files", 1), ("deleted_files", 0)]
+
+        replayed = []
+        replay(ARGUMENTS, lambda path, value: replayed.append(path))
+        assert replayed == items
+
+    def test_escaped_single_quotes(self):
+        assert parse(r'{"content": "it\'s"}') == {"content": r"it\'s"}
+        assert parse(r'{"content": "it\\\'s"}') == {"content": "it\\\\'s"}
+        for invalid in [r'{"content": "\x41"}', r'{"content": "\u00zz"}']:
+            with self.assertRaises(ValueError):
+                parse(invalid)
+
+    def test_incomplete(self):
+        parser = ArgumentParser()
+        parser.feed('{"files": [')
+        with self.assertRaises(ValueError):
+            parser.close()
@@ -1,8 +1,9 @@
-from typing import List, Optional, Union
+from typing import Dict, List, Optional, Union
 
 from agents.coder import WritePRParams
 from agents.contributor import AmendPRParams
 from ai import llm
+from ai.context import build_codebase
 from tools.github import GithubFile
 from tools.jira import Issue
 from utils.state import Conversation
@@ -15,7 +16,30 @@ def sumamrize_test_failure(
     failure_msg: str,
     repo_files: List[Optional[GithubFile]],
 ) -> str:
-    codebase = "\n".join(str(f) for f in repo_files)
+    summary = llm.stream_next(_test_failure_messages(pr, failure_msg, repo_files))
+    assert isinstance(summary, str)
+    return summary
+
+
+async def asumamrize_test_failure(
+    pr: Union[WritePRParams, AmendPRParams],
+    failure_msg: str,
+    repo_files: List[Optional[GithubFile]],
+) -> str:
+    summary = await llm.astream_next(
+        _test_failure_messages(pr, failure_msg, repo_files)
+    )
+    assert isinstance(summary, str)
+    return summary
+
+
+def _test_failure_messages(
+    pr: Union[WritePRParams, AmendPRParams],
+    failure_msg: str,
+    repo_files: List[Optional[GithubFile]],
+) -> List[Dict[str, str]]:
+    pr_paths = "\n".join(f.path for f in pr.files + pr.test_files)
+    codebase = build_codebase(repo_files, query=f"{failure_msg}\n{pr_paths}")
 
     PROMPT = f"""I wrote the following Pull Request with unit tests, but the tests failed.
     Help me understand the error and fix the tests.
@@ -37,34 +61,38 @@ def sumamrize_test_failure(
     Error: ...
     Fix: ..."""
 
-    summary = llm.stream_next(
-        [
-            {
-                "role": "user",
-                "content": PROMPT,
-            }
-        ]
-    )
-    assert isinstance(summary, str)
-    return summary
+    return [
+        {
+            "role": "user",
+            "content": PROMPT,
+        }
+    ]
 
 
 def there_is_followup(text: str) -> bool:
+    yes_no = llm.stream_next(_followup_messages(text))
+    assert isinstance(yes_no, str)
+    return "yes" in yes_no.lower()
+
+
+async def athere_is_followup(text: str) -> bool:
+    yes_no = await llm.astream_next(_followup_messages(text))
+    assert isinstance(yes_no, str)
+    return "yes" in yes_no.lower()
+
+
+def _followup_messages(text: str) -> List[Dict[str, str]]:
     PROMPT = f"""Does the following text explicitly say that there is a followup action?
     {text}
     
     yes/no"""
 
-    yes_no = llm.stream_next(
-        [
-            {
-                "role": "user",
-                "content": PROMPT,
-            }
-        ]
-    )
-    assert isinstance(yes_no, str)
-    return "yes" in yes_no.lower()
+    return [
+        {
+            "role": "user",
+            "content": PROMPT,
+        }
+    ]
 
 
 class SummaryParams(BaseModel):
@@ -103,7 +131,21 @@ def summarize_architecture(conversation: Conversation) -> SummaryParams:
 
 
 def suggest_code(ticket: Issue, repo_files: List[Optional[GithubFile]]) -> str:
-    codebase = "\n".join(str(f) for f in repo_files)
+    suggestion = llm.stream_next(_suggest_code_messages(ticket, repo_files))
+    assert isinstance(suggestion, str)
+    return suggestion
+
+
+async def asuggest_code(ticket: Issue, repo_files: List[Optional[GithubFile]]) -> str:
+    suggestion = await llm.astream_next(_suggest_code_messages(ticket, repo_files))
+    assert isinstance(suggestion, str)
+    return suggestion
+
+
+def _suggest_code_messages(
+    ticket: Issue, repo_files: List[Optional[GithubFile]]
+) -> List[Dict[str, str]]:
+    codebase = build_codebase(repo_files, query=str(ticket))
 
     PROMPT = f"""I have to finish the following Jira ticket:
 
@@ -115,13 +157,9 @@ def suggest_code(ticket: Issue, repo_files: List[Optional[GithubFile]]) -> str:
 
     In 1 or 2 sentences, suggest me what code to write. Provide no code examples."""
 
-    suggestion = llm.stream_next(
-        [
-            {
-                "role": "user",
-                "content": PROMPT,
-            }
-        ]
-    )
-    assert isinstance(suggestion, str)
-    return suggestion
+    return [
+        {
+            "role": "user",
+            "content": PROMPT,
+        }
+    ]
@@ -1,9 +1,28 @@
+import asyncio
+import gzip
+import itertools
 import os
 import subprocess
 import threading
+import time
+import weakref
+from collections import deque
 from pydantic import BaseModel
-from queue import Empty, Queue
-from typing import ClassVar, List, Type, Union
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Coroutine,
+    Deque,
+    Dict,
+    List,
+    Optional,
+    TextIO,
+    Tuple,
+    Type,
+    TypeVar,
+    Union,
+)
 
 from utils.io import print_system
 from utils import state
@@ -13,146 +32,490 @@ from utils.state import Command, CommandStatus
 DOCKER_NAME = os.environ["DOCKER_NAME"]
 
 
-# Open "connection" with docker through the "-i" flag
-process = subprocess.Popen(
-    ["docker", "exec", "-i", DOCKER_NAME, "bash"],
-    stdin=subprocess.PIPE,
-    stdout=subprocess.PIPE,
-    stderr=subprocess.PIPE,
-    text=True,
-    bufsize=1,
-    universal_newlines=True,
-)
+SENTINEL = "__GCPAL_DONE__"
+TIMEOUT = 5
+# How long an interrupted command gets to exit before the shell is re-created
+GRACE = 5
+# Longest line read from a shell
+LINE_LIMIT = 1024 * 1024
 
+# Lines kept in memory per command. Lines in between are only in the log.
+HEAD_LINES = 1000
+TAIL_LINES = 4000
+LOGS_DIR = "db/logs"
+LOG_OUTPUT = os.environ.get("LOG_OUTPUT", "False") == "True"
+
+T = TypeVar("T")
 
-COMMAND_EXECUTED = "COMMAND_EXECUTED"
-ERROR_PREFIXES = ["ERROR:", "fatal:"]
-TIMEOUT = 5
+
+class Timeout(BaseModel):
+    # Seconds without any output
+    inactivity: Optional[float] = TIMEOUT
+    # Seconds since the command started
+    total: Optional[float] = None
+    # Print progress every so many seconds of silence
+    heartbeat: Optional[float] = None
+
+
+DEFAULT_TIMEOUT = Timeout()
 
 
 class StdOut(BaseModel):
     msg: str
-    exit_signal: ClassVar[str] = "EXIT_STDOUT"
 
 
 class StdErr(BaseModel):
     msg: str
-    exit_signal: ClassVar[str] = "EXIT_STDERR"
 
 
-class DockerRunner:
-    def __init__(self, startup_commands: List[str] = []):
+Line = Union[StdOut, StdErr]
+
+
+class Output:
+    def __init__(
+        self,
+        log_path: Optional[str] = None,
+        on_line: Optional[Callable[[Line], Any]] = None,
+    ):
+        # Lines keep their stream, so stderr isn't stored twice
+        self.head: List[Line] = []
+        self.tail: Deque[Line] = deque(maxlen=TAIL_LINES)
+        self.omitted = 0
+        self.stdout_bytes = 0
+        self.stderr_bytes = 0
+        self.exit_code: Optional[int] = None
+        self.on_line = on_line
+        self.log: Optional[TextIO] = None
+        self.log_path = log_path
+        if log_path:
+            os.makedirs(os.path.dirname(log_path), exist_ok=True)
+            self.log = gzip.open(log_path, "wt")
+
+    def append(self, output: Line) -> None:
+        size = len(output.msg.encode()) + 1
+        if isinstance(output, StdErr):
+            self.stderr_bytes += size
+        else:
+            self.stdout_bytes += size
+        if self.log:
+            self.log.write(f"{output.msg}\n")
+        if self.on_line:
+            self.on_line(output)
+
+        if len(self.head) < HEAD_LINES:
+            self.head.append(output)
+            return
+        if len(self.tail) == TAIL_LINES:
+            self.omitted += 1
+        self.tail.append(output)
+
+    def lines(self) -> List[str]:
+        return [line.msg for line in itertools.chain(self.head, self.tail)]
+
+    def stderr_lines(self) -> List[int]:
+        return [
+            i
+            for i, line in enumerate(itertools.chain(self.head, self.tail))
+            if isinstance(line, StdErr)
+        ]
+
+    def close(self) -> None:
+        if self.log:
+            self.log.close()
+
+
+class SessionTimeout(Exception):
+    def __init__(self, output: Output, restarted: bool = False):
+        super().__init__("Command timed out")
+        self.output = output
+        self.restarted = restarted
+
+
+class _Expired(Exception):
+    pass
+
+
+class Session:
+    def __init__(self, name: str, container: str = DOCKER_NAME):
+        self.name = name
+        self.container = container
+        # Commands on one shell run one at a time
+        self.lock = asyncio.Lock()
+        self.ids = itertools.count()
+        self.env_path = f"/tmp/gcpal-{name}.env"
+        self.process: Optional[asyncio.subprocess.Process] = None
+
+    async def start(self) -> None:
+        async with self.lock:
+            if self.process is None:
+                await self._spawn()
+
+    async def run(
+        self,
+        command: str,
+        timeout: Timeout = DEFAULT_TIMEOUT,
+        output: Optional[Output] = None,
+    ) -> Output:
+        output = output or Output()
+        async with self.lock:
+            marker = await self._write(command)
+            try:
+                await self._read(marker, timeout, output)
+                return output
+            except _Expired:
+                pass
+
+            # Interrupt just the running command and keep the shell
+            print_system("--- INTERRUPTING ---")
+            restarted = False
+            try:
+                await self._interrupt()
+                await self._read(marker, Timeout(inactivity=GRACE), output)
+            except (_Expired, asyncio.TimeoutError, subprocess.SubprocessError):
+                await self._respawn()
+                restarted = True
+            raise SessionTimeout(output, restarted=restarted)
+
+    async def restart(self) -> None:
+        async with self.lock:
+            await self._respawn()
+
+    async def _write(self, command: str) -> str:
+        assert self.process and self.process.stdin
+        marker = f"{SENTINEL}{self.name}:{next(self.ids)}"
+        # The sentinel carries the exit code on stdout, and flushes stderr.
+        # The environment is saved after every command, so a new shell can resume.
+        self.process.stdin.write(
+            (
+                f"{command}\n"
+                "__gcpal_rc=$?; "
+                f'{{ export -p; printf "cd -- %q\\n" "$PWD"; }} > {self.env_path}; '
+                f'echo "{marker} $__gcpal_rc"; echo "{marker}" >&2\n'
+            ).encode()
+        )
+        await self.process.stdin.drain()
+        return marker
+
+    async def _read(
+        self,
+        marker: str,
+        timeout: Timeout,
+        output: Output,
+        echo: bool = True,
+    ) -> None:
+        start = last_output = last_beat = time.monotonic()
+        stderr_done = False
+        while output.exit_code is None or not stderr_done:
+            deadlines = []
+            if timeout.inactivity is not None:
+                deadlines.append(last_output + timeout.inactivity)
+            if timeout.total is not None:
+                deadlines.append(start + timeout.total)
+            if timeout.heartbeat is not None:
+                deadlines.append(max(last_output, last_beat) + timeout.heartbeat)
+            wait = max(min(deadlines) - time.monotonic(), 0) if deadlines else None
+
+            try:
+                line = await asyncio.wait_for(self.queue.get(), wait)
+            except asyncio.TimeoutError:
+                now = time.monotonic()
+                if (
+                    timeout.inactivity is not None
+                    and now - last_output >= timeout.inactivity
+                ) or (timeout.total is not None and now - start >= timeout.total):
+                    raise _Expired()
+                print_system(f"... still running ({now - start:.0f}s)")
+                last_beat = now
+                continue
+            if line is None:  # The shell exited
+                raise _Expired()
+            last_output = time.monotonic()
+
+            start_sentinel = line.msg.find(SENTINEL)
+            if start_sentinel >= 0:
+                sentinel = line.msg[start_sentinel:]
+                # Output without a final newline shares its line with the sentinel
+                line = type(line)(msg=line.msg[:start_sentinel])
+                # Sentinels of commands abandoned by a timeout are skipped
+                if sentinel.startswith(f"{marker} ") and isinstance(line, StdOut):
+                    output.exit_code = int(sentinel.split()[-1])
+                elif sentinel == marker and isinstance(line, StdErr):
+                    stderr_done = True
+                if not line.msg:
+                    continue
+
+            output.append(line)
+            if echo:
+                print_system(line.msg)
+
+    async def _interrupt(self) -> None:
+        assert self.process
+        if self.process.returncode is not None:
+            raise subprocess.SubprocessError("The shell exited")
+        # With job control on, each command the shell runs leads its own group
+        kill = await asyncio.create_subprocess_exec(
+            "docker",
+            "exec",
+            self.container,
+            "sh",
+            "-c",
+            f"for p in $(cat /proc/{self.pid}/task/{self.pid}/children); "
+            "do kill -INT -$p; done",
+        )
+        if await asyncio.wait_for(kill.wait(), GRACE) != 0:
+            raise subprocess.SubprocessError("Couldn't interrupt the command")
+
+    async def _respawn(self) -> None:
+        assert self.process
+        if self.process.returncode is None:
+            self.process.kill()
+        await self.process.wait()
+        await self._spawn(restore=True)
+
+    async def _spawn(self, restore: bool = False) -> None:
+        # Open "connection" with docker through the "-i" flag
+        self.process = await asyncio.create_subprocess_exec(
+            "docker",
+            "exec",
+            "-i",
+            self.container,
+            "bash",
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            limit=LINE_LIMIT,
+        )
+        # Readers live as long as the shell; each shell gets its own queue
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.readers = [
+            asyncio.create_task(_stream(reader, self.queue, output))
+            for reader, output in [
+                (self.process.stdout, StdOut),
+                (self.process.stderr, StdErr),
+            ]
+        ]
+
+        # Job control puts each command in its own process group, so it can be
+        # interrupted without signaling the shell. The trap keeps the shell alive.
+        setup = "set -m; trap : INT; "
+        if restore:
+            # Working directory, exports and the activated venv of the last shell
+            setup += f"source {self.env_path} 2> /dev/null; "
+        output = Output()
+        await self._read(
+            await self._write(f"{setup}echo $$"),
+            DEFAULT_TIMEOUT,
+            output,
+            echo=False,
+        )
+        self.pid = int(output.lines()[-1])
+
+
+# Subprocess pipes belong to the event loop that created them
+_sessions: "weakref.WeakKeyDictionary[Any, Dict[Tuple[str, str], Session]]"
+_sessions = weakref.WeakKeyDictionary()
+
+
+async def get_session(name: str = "default", container: str = DOCKER_NAME) -> Session:
+    sessions = _sessions.setdefault(asyncio.get_running_loop(), {})
+    if (container, name) not in sessions:
+        sessions[(container, name)] = Session(name, container=container)
+    session = sessions[(container, name)]
+    await session.start()
+    return session
+
+
+class AsyncDockerRunner:
+    def __init__(
+        self,
+        startup_commands: List[str] = [],
+        session: str = "default",
+        container: str = DOCKER_NAME,
+    ):
         self.adhoc_commands = startup_commands
-        self.startup()
-
-    def execute(self, commands: List[str]) -> List[Command]:
-        global process
-        assert process.stdin
-
-        queue = Queue()
-
-        def _stream(pipe, q: Queue, output: Type[Union[StdOut, StdErr]]) -> None:
-            # Wait for updates from docker
-            while True:
-                line = pipe.readline().strip()
-                q.put(output(msg=line))  # Send message back to the main thread
-                if output.exit_signal in line or (
-                    not line and process.poll() is not None
-                ):
-                    break
-
-        # One thread for stdout, one thread for stderr
-        stdout = threading.Thread(target=_stream, args=(process.stdout, queue, StdOut))
-        stderr = threading.Thread(target=_stream, args=(process.stderr, queue, StdErr))
-        stdout.start()
-        stderr.start()
-
+        self.container = container
+        self.session_name = session
+        self.session: Optional[Session] = None
+
+    async def start(self) -> "AsyncDockerRunner":
+        self.session = await get_session(self.session_name, container=self.container)
+        await self.startup()
+        return self
+
+    async def execute(
+        self,
+        commands: List[str],
+        stop_on_error: bool = True,
+        timeout: Timeout = DEFAULT_TIMEOUT,
+    ) -> List[Command]:
         executed_commands = []
-        status = CommandStatus.SUCCESS
         # Iterate over commands
         for command in commands:
-            process.stdin.write(f"{command}\n")
-            process.stdin.write(f"echo {COMMAND_EXECUTED}\n")  # Signal of executed
-            process.stdin.flush()
-            print_system(f"# {command}")
-
-            msgs = []
-            try:  # Catch timeouts
-                output = queue.get(timeout=TIMEOUT)
-                # Iterate over the command stdout or stderr until COMMAND_EXECUTED
-                while COMMAND_EXECUTED not in output.msg:
-                    msgs.append(output.msg)
-                    print_system(output.msg)
-                    if isinstance(output, StdErr) and _confirm_error(output.msg):
-                        # Regular outputs sometimes get sent to stderr
-                        # Real errors usually have an ERROR:  prefix
-                        status = CommandStatus.ERROR
-                        break
-                    output = queue.get(timeout=TIMEOUT)
-            except Empty:
-                print_system("--- TIMEOUT ---")
-                # Close connection
-                _signal_exit()
-                process.terminate()
-                process.kill()
-                # Waiting ends in actual timeouts
-                # stdout.join()
-                # stderr.join()
-
-                # Re-create
-                process = subprocess.Popen(
-                    ["docker", "exec", "-i", DOCKER_NAME, "bash"],
-                    stdin=subprocess.PIPE,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    text=True,
-                    bufsize=1,
-                    universal_newlines=True,
-                )
-                self.startup()
-
-                # Exit
-                status = CommandStatus.TIMEOUT
-                return executed_commands
-            finally:
-                executed_command = Command(command=command, output=msgs, status=status)
-                executed_commands.append(executed_command)
-                _persist_command(executed_command)
-
-            if executed_command.status != CommandStatus.SUCCESS:
-                # Stop on error
+            executed_command = await self.execute_one(command, timeout=timeout)
+            executed_commands.append(executed_command)
+            if stop_on_error and executed_command.status != CommandStatus.SUCCESS:
                 break
 
-        _signal_exit()
-        stdout.join()
-        stderr.join()
-
         return executed_commands
 
-    def execute_one(self, command: str) -> Command:
-        return self.execute([command])[0]
+    async def execute_one(
+        self,
+        command: str,
+        timeout: Timeout = DEFAULT_TIMEOUT,
+        on_line: Optional[Callable[[Line], Any]] = None,
+    ) -> Command:
+        assert self.session
+        print_system(f"# {command}")
+
+        start = time.monotonic()
+        restarted = False
+        output = Output(
+            log_path=self._log_path() if LOG_OUTPUT else None, on_line=on_line
+        )
+        try:  # Catch timeouts
+            await self.session.run(command, timeout=timeout, output=output)
+            # Regular outputs often go to stderr, so only the exit code counts
+            status = CommandStatus.SUCCESS
+            if output.exit_code != 0:
+                status = CommandStatus.ERROR
+        except SessionTimeout as e:
+            print_system("--- TIMEOUT ---")
+            status = CommandStatus.TIMEOUT
+            restarted = e.restarted
+        finally:
+            output.close()
+
+        executed_command = Command(
+            command=command,
+            output=output.lines(),
+            omitted=output.omitted,
+            omitted_at=len(output.head),
+            stderr_lines=output.stderr_lines(),
+            status=status,
+            exit_code=None if status == CommandStatus.TIMEOUT else output.exit_code,
+            duration=time.monotonic() - start,
+            stdout_bytes=output.stdout_bytes,
+            stderr_bytes=output.stderr_bytes,
+            log_path=output.log_path,
+        )
+        _persist_command(executed_command)
+
+        if restarted:
+            # The new shell resumed the environment, so only check the agent
+            await self.setup()
+        return executed_command
+
+    async def stream(
+        self, command: str, timeout: Timeout = DEFAULT_TIMEOUT
+    ) -> AsyncIterator[Line]:
+        # Lines are yielded as they arrive, the Command is recorded as usual
+        lines: asyncio.Queue = asyncio.Queue()
+        task = asyncio.create_task(
+            self.execute_one(command, timeout=timeout, on_line=lines.put_nowait)
+        )
+        task.add_done_callback(lambda _: lines.put_nowait(None))
+        while True:
+            line = await lines.get()
+            if line is None:
+                break
+            yield line
+        await task
 
-    def startup(self) -> List[Command]:
-        return self.execute(
+    async def setup(self) -> List[Command]:
+        # Each step is skipped when it's already done
+        return await self.execute(
             [
-                "eval $(ssh-agent -s)",
-                "ssh-add /root/.ssh/github",
-                "ssh-keyscan -H github.com >> /root/.ssh/known_hosts",
+                '[ -S "$SSH_AUTH_SOCK" ] || eval $(ssh-agent -s)',
+                "ssh-add -l > /dev/null || ssh-add /root/.ssh/github",
+                "ssh-keygen -F github.com > /dev/null"
+                " || ssh-keyscan -H github.com >> /root/.ssh/known_hosts",
             ]
-        ) + self.execute(self.adhoc_commands)
+        )
 
+    async def startup(self) -> List[Command]:
+        return await self.setup() + await self.execute(self.adhoc_commands)
 
-def _confirm_error(msg: str) -> bool:
-    return any(e in msg for e in ERROR_PREFIXES)
+    def _log_path(self) -> str:
+        return f"{LOGS_DIR}/{self.session_name}/{time.time_ns()}.log.gz"
 
 
-def _persist_command(command: Command) -> None:
-    state.command_list.append(command)
+class DockerRunner:
+    # Blocking facade over AsyncDockerRunner for the synchronous workflows
+    def __init__(
+        self,
+        startup_commands: List[str] = [],
+        session: str = "default",
+        container: str = DOCKER_NAME,
+    ):
+        self.runner = AsyncDockerRunner(
+            startup_commands, session=session, container=container
+        )
+        self.container = container
+        _run(self.runner.start())
+
+    @property
+    def adhoc_commands(self) -> List[str]:
+        return self.runner.adhoc_commands
+
+    @adhoc_commands.setter
+    def adhoc_commands(self, commands: List[str]) -> None:
+        self.runner.adhoc_commands = commands
+
+    def execute(
+        self,
+        commands: List[str],
+        stop_on_error: bool = True,
+        timeout: Timeout = DEFAULT_TIMEOUT,
+    ) -> List[Command]:
+        return _run(
+            self.runner.execute(commands, stop_on_error=stop_on_error, timeout=timeout)
+        )
+
+    def execute_one(self, command: str, timeout: Timeout = DEFAULT_TIMEOUT) -> Command:
+        return _run(self.runner.execute_one(command, timeout=timeout))
+
+    def setup(self) -> List[Command]:
+        return _run(self.runner.setup())
+
+    def startup(self) -> List[Command]:
+        return _run(self.runner.startup())
+
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_lock = threading.Lock()
+
+
+def _run(coroutine: Coroutine[Any, Any, T]) -> T:
+    # Blocking callers share one event loop thread, which drives every shell
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, daemon=True).start()
+    return asyncio.run_coroutine_threadsafe(coroutine, _loop).result()
+
+
+async def _stream(
+    reader: Optional[asyncio.StreamReader],
+    q: asyncio.Queue,
+    output: Type[Line],
+) -> None:
+    assert reader
+    # Wait for updates from docker
+    while True:
+        try:
+            line = await reader.readline()
+        except ValueError:
+            # The rest of a line over LINE_LIMIT is dropped
+            q.put_nowait(output(msg="... (line too long)"))
+            continue
+        if not line:
+            break
+        # Send message back to the caller
+        q.put_nowait(output(msg=line.decode(errors="replace").strip()))
+    q.put_nowait(None)
 
 
-def _signal_exit() -> None:
-    global process
-    assert process.stdin
-    process.stdin.write(f"echo {StdOut.exit_signal}\n")
-    process.stdin.write(f"{StdErr.exit_signal}\n")
-    process.stdin.flush()
+def _persist_command(command: Command) -> None:
+    with state.command_lock:
+        state.command_list.append(command)
@@ -1,22 +1,44 @@
+import io
 import os
 import subprocess
-from typing import List
+import tarfile
+import time
+from typing import List, Optional
 
 from agents.coder import File
-from tools.docker.commands import DockerRunner
 
 
 DOCKER_NAME = os.environ["DOCKER_NAME"]
 
 
-def copy_files(files: List[File], root: str, container_path: str, docker: DockerRunner):
-    for file in files:
-        ogi_path = f"{root}/{file.path}"
-        dst_path = f"{container_path}/{file.path}"
-        intermediate_dirs, _ = os.path.split(dst_path)
-        docker.execute_one(f"mkdir -p {intermediate_dirs}")
-        subprocess.run(
-            f"docker cp {ogi_path} {DOCKER_NAME}:{dst_path}",
-            check=True,
-            shell=True,
-        )
+def copy_files(files: List[File], container_path: str, container: str = DOCKER_NAME):
+    # One tar stream for all the files. Missing directories are created on extract.
+    archive = io.BytesIO()
+    now = time.time()
+    with tarfile.open(fileobj=archive, mode="w") as tar:
+        for file in files:
+            content = file.content.encode("utf-8")
+            info = tarfile.TarInfo(name=file.path)
+            info.size = len(content)
+            info.mode = 0o644
+            info.mtime = int(now)
+            tar.addfile(info, io.BytesIO(content))
+
+    subprocess.run(
+        ["docker", "cp", "-", f"{container}:{container_path}"],
+        input=archive.getvalue(),
+        check=True,
+    )
+
+
+def read_file(
+    container_path: str, container: str = DOCKER_NAME, remove: bool = False
+) -> Optional[str]:
+    result = subprocess.run(
+        ["docker", "exec", container, "cat", container_path], capture_output=True
+    )
+    if remove:
+        subprocess.run(["docker", "exec", container, "rm", "-f", container_path])
+    if result.returncode != 0:
+        return None
+    return result.stdout.decode("utf-8", errors="replace")
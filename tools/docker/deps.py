@@ -0,0 +1,44 @@
+from tools.docker.commands import DockerRunner, Timeout
+from utils.state import Command
+
+
+VENVS_DIR = "/home/.venvs"
+PIP_CACHE_DIR = "/root/.cache/gcpal-pip"
+MAX_SNAPSHOTS = 5
+
+# Installs can be silent for long stretches
+INSTALL_TIMEOUT = Timeout(inactivity=None, total=15 * 60)
+
+# Runs from the repo root or a worktree, with the repo's venv active.
+# .requirements holds the hash of the installed requirements. Snapshots are
+# hardlinked copies of the venv; pip unlinks files before writing them, so
+# installs never modify a snapshot.
+SYNC_SCRIPT = f"""(
+set -e
+test -n "$VIRTUAL_ENV"
+hash=$(sha256sum requirements.txt | cut -c1-16)
+repo=$(basename "$(dirname "$VIRTUAL_ENV")")
+snapshot={VENVS_DIR}/$repo-$hash
+if [ "$(cat "$VIRTUAL_ENV/.requirements" 2> /dev/null)" = "$hash" ]; then
+  echo "Requirements $hash are already installed"
+elif [ -d "$snapshot" ]; then
+  rm -rf "$VIRTUAL_ENV"
+  cp -al "$snapshot" "$VIRTUAL_ENV"
+  echo "Restored requirements $hash"
+else
+  python3 -m pip install --cache-dir {PIP_CACHE_DIR} -r requirements.txt
+  rm -f "$VIRTUAL_ENV/.requirements"
+  echo "$hash" > "$VIRTUAL_ENV/.requirements"
+  mkdir -p {VENVS_DIR}
+  rm -rf "$snapshot"
+  cp -al "$VIRTUAL_ENV" "$snapshot"
+  # Other repos' names can start with "$repo-" too
+  ls -dt {VENVS_DIR}/$repo-* | grep -E "/$repo-[0-9a-f]{{16}}$" \\
+    | tail -n +{MAX_SNAPSHOTS + 1} | xargs -r rm -rf
+fi
+)"""
+
+
+def sync(docker: DockerRunner, timeout: Timeout = INSTALL_TIMEOUT) -> Command:
+    # Makes the venv match requirements.txt, without reinstalling when it already does
+    return docker.execute_one(SYNC_SCRIPT, timeout=timeout)
@@ -0,0 +1,97 @@
+import fcntl
+import os
+import time
+from contextlib import contextmanager
+from typing import Iterator, List, TextIO, Tuple
+
+from tools.docker import deps
+from tools.docker.commands import DockerRunner, DOCKER_NAME, Timeout
+from utils.io import print_system
+from utils.state import CommandStatus
+
+
+DOCKER_NAMES = os.environ.get("DOCKER_NAMES", DOCKER_NAME).split(",")
+LOCKS_DIR = "db/pool"
+POLL_INTERVAL = 1
+
+# Cloning can be silent for long stretches
+WARM_TIMEOUT = Timeout(inactivity=None, total=15 * 60)
+
+
+class PoolError(Exception):
+    pass
+
+
+def warm_commands(repo: str) -> List[str]:
+    # Every step is cheap when the container is already warm. Resets after each
+    # lease keep it that way.
+    return [
+        f"[ -d /home/{repo} ]"
+        f" || git clone git@github.com:lgaleana/{repo}.git /home/{repo}",
+        f"cd /home/{repo}",
+        "[ -d venv ] || python3 -m venv venv",
+        "source venv/bin/activate",
+        "git checkout main",
+        "git pull origin main --rebase",
+    ]
+
+
+def reset_commands(repo: str) -> List[str]:
+    return [
+        f"cd /home/{repo}",
+        "git checkout -f main",
+        "git clean -fd",
+        "git fetch origin main",
+        "git reset --hard origin/main",
+        f"rm -rf /home/{repo}.worktrees",
+        "git worktree prune",
+    ]
+
+
+@contextmanager
+def lease(repo: str, containers: List[str] = DOCKER_NAMES) -> Iterator[DockerRunner]:
+    container, lock = _acquire(containers)
+    try:
+        print_system(f"Leased container {container}")
+        docker = DockerRunner(container=container)
+        warm(repo, docker)
+        try:
+            yield docker
+        finally:
+            # Leave the checkout ready for the next lease
+            docker.execute(
+                reset_commands(repo), stop_on_error=False, timeout=WARM_TIMEOUT
+            )
+            deps.sync(docker)
+    finally:
+        fcntl.flock(lock, fcntl.LOCK_UN)
+        lock.close()
+
+
+def warm(repo: str, docker: DockerRunner) -> None:
+    commands = docker.execute(warm_commands(repo), timeout=WARM_TIMEOUT)
+    if commands[-1].status == CommandStatus.SUCCESS:
+        commands.append(deps.sync(docker))
+    if commands[-1].status != CommandStatus.SUCCESS:
+        raise PoolError(
+            f"Error warming {docker.container} :: `{commands[-1].command}`. "
+            f"Error :: {commands[-1].output_str()}"
+        )
+
+
+def _acquire(containers: List[str]) -> Tuple[str, TextIO]:
+    # File locks, so leases also hold across workflow processes
+    os.makedirs(LOCKS_DIR, exist_ok=True)
+    waiting = False
+    while True:
+        for container in containers:
+            lock = open(f"{LOCKS_DIR}/{container}.lock", "w")
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return container, lock
+            except BlockingIOError:
+                lock.close()
+        if not waiting:
+            print_system("Waiting for a free container...")
+            waiting = True
+        time.sleep(POLL_INTERVAL)
@@ -0,0 +1,72 @@
+import asyncio
+import os
+import tempfile
+from typing import List
+from unittest import TestCase
+from unittest.mock import patch
+
+for name in ["DOCKER_NAME", "GITHUB_TOKEN", "OPENAI_API_KEY"]:
+    os.environ.setdefault(name, "test")
+
+from tools.docker.commands import Output, Session, Timeout
+
+
+# Stands in for docker: `docker exec [-i] CONTAINER cmd...` runs cmd locally
+DOCKER = """#!/bin/bash
+shift
+[ "$1" = "-i" ] && shift
+shift
+exec "$@"
+"""
+
+
+class SessionTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        with open(f"{directory.name}/docker", "w") as file:
+            file.write(DOCKER)
+        os.chmod(f"{directory.name}/docker", 0o755)
+        path = f"{directory.name}:{os.environ['PATH']}"
+        patcher = patch.dict(os.environ, {"PATH": path})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_commands(self, *commands: str) -> List[Output]:
+        async def run() -> List[Output]:
+            session = Session(f"test-{os.getpid()}")
+            self.addCleanup(lambda: os.remove(session.env_path))
+            await session.start()
+            try:
+                return [
+                    await session.run(c, timeout=Timeout(inactivity=5))
+                    for c in commands
+                ]
+            finally:
+                assert session.process
+                session.process.kill()
+                await session.process.wait()
+
+        return asyncio.run(run())
+
+    def test_output(self):
+        output, cd, pwd = self.run_commands("echo out; echo err >&2", "cd /", "pwd")
+        self.assertEqual(output.lines(), ["out", "err"])
+        self.assertEqual(output.stderr_lines(), [1])
+        self.assertEqual(pwd.lines(), ["/"])
+
+    def test_exit_code(self):
+        ok, failed = self.run_commands("true", "false")
+        self.assertEqual(ok.exit_code, 0)
+        self.assertEqual(failed.exit_code, 1)
+
+    def test_no_final_newline(self):
+        stdout, stderr, after = self.run_commands(
+            "printf foo", "printf err >&2; exit_code() { return 3; }; exit_code", "pwd"
+        )
+        self.assertEqual(stdout.lines(), ["foo"])
+        self.assertEqual(stdout.exit_code, 0)
+        self.assertEqual(stderr.lines(), ["err"])
+        self.assertEqual(stderr.stderr_lines(), [0])
+        self.assertEqual(stderr.exit_code, 3)
+        self.assertEqual(after.exit_code, 0)
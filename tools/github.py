@@ -1,9 +1,15 @@
 import base64
+import hashlib
+import json
 import os
 import requests
+import tarfile
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from fnmatch import fnmatch
 from pydantic import BaseModel
-from typing import List, Optional, Union
+from requests.adapters import HTTPAdapter
+from typing import Any, Collection, Dict, List, Optional, Union
 
 from utils.io import print_system
 
@@ -15,15 +21,34 @@ HEADERS = {
     "Accept": "application/vnd.github.v3+json",
 }
 
+BLOBS_DIR = "db/blobs"
+COMMENTS_DIR = "db/comments"
+MAX_WORKERS = 16
+MAX_COMPARE_FILES = 300
+PER_PAGE = 100
+
+# Pooled connections shared by the snapshot fetcher threads
+session = requests.Session()
+session.headers.update(HEADERS)
+session.mount("https://", HTTPAdapter(pool_maxsize=MAX_WORKERS))
+
 
 class GithubFile(BaseModel):
     path: str
     content: str
+    sha: Optional[str] = None
 
     def __str__(self) -> str:
         return f"{self.path}\n" "```\n" f"{self.content}\n" "```"
 
 
+class Snapshot(BaseModel):
+    repo: str
+    branch: str
+    commit: str
+    files: List[GithubFile]
+
+
 class Commit(BaseModel):
     sha: str
     author: str
@@ -68,50 +93,207 @@ class PRCreationError(Exception):
 
 
 class ReviewComment(GithubComment):
+    path: str
     line: int
     diff_hunk: str
 
     def __str__(self) -> str:
         return (
-            f"@{self.author}:\n"
+            f"@{self.author} on {self.path}:\n"
             f"```\n{self.diff_hunk}\n```\n\n"
             f"line {self.line}: {self.body}"
         )
 
 
-def get_repo_files(repo: str, branch: str = "main") -> List[Optional[GithubFile]]:
-    response = requests.get(
-        f"https://api.github.com/repos/lgaleana/{repo}/git/trees/{branch}?recursive=1",
-        headers=HEADERS,
+def get_repo_files(
+    repo: str,
+    branch: str = "main",
+    archive: bool = False,
+    include: Optional[List[str]] = None,
+) -> List[Optional[GithubFile]]:
+    if archive:
+        return get_repo_archive(repo, branch=branch, include=include)
+
+    response = session.get(
+        f"https://api.github.com/repos/lgaleana/{repo}/git/trees/{branch}?recursive=1"
+    )
+    response.raise_for_status()
+
+    blobs = [
+        f
+        for f in response.json()["tree"]
+        if f["type"] == "blob" and _is_included(f["path"], include)
+    ]
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        contents = executor.map(
+            lambda f: get_blob_contents(f["path"], f["sha"], repo=repo), blobs
+        )
+        return [
+            GithubFile(path=f["path"], content=content, sha=f["sha"])
+            for f, content in zip(blobs, contents)
+        ]
+
+
+def get_repo_archive(
+    repo: str, branch: str = "main", include: Optional[List[str]] = None
+) -> List[Optional[GithubFile]]:
+    response = session.get(
+        f"https://api.github.com/repos/lgaleana/{repo}/tarball/{branch}",
+        stream=True,
     )
     response.raise_for_status()
 
     file_contents = []
-    repo_data = response.json()
-    for file in repo_data["tree"]:
-        if file["type"] == "blob":  # Make sure it's a file
-            file_contents.append(get_file_contents(file["path"], repo=repo))
+    response.raw.decode_content = True
+    # Stream mode reads members in order without buffering the archive
+    with response, tarfile.open(fileobj=response.raw, mode="r|*") as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            # Members are prefixed with a {owner}-{repo}-{sha} directory
+            _, _, file_path = member.name.partition("/")
+            if not _is_included(file_path, include):
+                continue
+
+            if _is_elided(file_path):
+                content = "..."
+                sha = None
+            else:
+                extracted = tar.extractfile(member)
+                assert extracted
+                raw = extracted.read()
+                content = _decode(raw)
+                sha = _blob_sha(raw)
+            file_contents.append(GithubFile(path=file_path, content=content, sha=sha))
     return file_contents
 
 
+def get_snapshot(repo: str, branch: str = "main", archive: bool = False) -> Snapshot:
+    commit = get_head_sha(repo, branch=branch)
+    # Pin the files to the commit so later refreshes can diff against it
+    files = get_repo_files(repo, branch=commit, archive=archive)
+    return Snapshot(repo=repo, branch=branch, commit=commit, files=files)
+
+
+def refresh_snapshot(snapshot: Snapshot) -> Snapshot:
+    head = get_head_sha(snapshot.repo, branch=snapshot.branch)
+    if head == snapshot.commit:
+        return snapshot
+
+    response = session.get(
+        f"https://api.github.com/repos/lgaleana/{snapshot.repo}/compare/{snapshot.commit}...{head}"
+    )
+    response.raise_for_status()
+    comparison = response.json()
+    # Force pushes and compares truncated at 300 files need a full reload
+    if comparison["status"] not in ["ahead", "identical"] or len(
+        comparison["files"]
+    ) >= MAX_COMPARE_FILES:
+        print_system(f"Reloading {snapshot.repo}@{snapshot.branch}...")
+        return get_snapshot(snapshot.repo, branch=snapshot.branch)
+
+    files = {f.path: f for f in snapshot.files}
+    changed = []
+    for file in comparison["files"]:
+        if file["status"] == "renamed":
+            files.pop(file["previous_filename"], None)
+        if file["status"] == "removed":
+            files.pop(file["filename"], None)
+        else:
+            changed.append(file)
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        contents = executor.map(
+            lambda f: get_blob_contents(f["filename"], f["sha"], repo=snapshot.repo),
+            changed,
+        )
+        for f, content in zip(changed, contents):
+            files[f["filename"]] = GithubFile(
+                path=f["filename"], content=content, sha=f["sha"]
+            )
+
+    print_system(f"Refreshed {len(comparison['files'])} files from {snapshot.repo}.")
+    return Snapshot(
+        repo=snapshot.repo,
+        branch=snapshot.branch,
+        commit=head,
+        files=sorted(files.values(), key=lambda f: f.path),
+    )
+
+
+def get_head_sha(repo: str, branch: str = "main") -> str:
+    response = session.get(
+        f"https://api.github.com/repos/lgaleana/{repo}/commits/{branch}",
+        headers={"Accept": "application/vnd.github.sha"},
+    )
+    response.raise_for_status()
+    return response.text.strip()
+
+
+def get_blob_contents(file_path: str, sha: str, repo: str) -> str:
+    if _is_elided(file_path):
+        return "..."
+
+    # Blobs are content-addressed, so a cached sha never goes stale
+    cache_path = f"{BLOBS_DIR}/{sha[:2]}/{sha}"
+    if os.path.exists(cache_path):
+        with open(cache_path, "rb") as f:
+            return _decode(f.read())
+
+    response = session.get(
+        f"https://api.github.com/repos/lgaleana/{repo}/git/blobs/{sha}",
+        headers={"Accept": "application/vnd.github.raw+json"},
+    )
+    response.raise_for_status()
+
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(response.content)
+    os.replace(tmp_path, cache_path)
+    return _decode(response.content)
+
+
 def get_file_contents(file_path: str, repo: str) -> Optional[GithubFile]:
-    response = requests.get(
-        f"https://api.github.com/repos/lgaleana/{repo}/contents/{file_path}",
-        headers=HEADERS,
+    response = session.get(
+        f"https://api.github.com/repos/lgaleana/{repo}/contents/{file_path}"
     )
     response.raise_for_status()
 
     file_data = response.json()
-    # TODO: Make this more generic
-    if file_path.endswith("package-lock.json") or file_path.endswith("package.json"):
+    if _is_elided(file_path):
         content = "..."
     else:
         # Decode the base64 content
         try:
-            content = base64.b64decode(file_data["content"]).decode("utf-8")
+            content = _decode(base64.b64decode(file_data["content"]))
         except:
             content = "..."
-    return GithubFile(path=file_path, content=content)
+    return GithubFile(path=file_path, content=content, sha=file_data.get("sha"))
+
+
+def _is_elided(file_path: str) -> bool:
+    # TODO: Make this more generic
+    return file_path.endswith("package-lock.json") or file_path.endswith(
+        "package.json"
+    )
+
+
+def _is_included(file_path: str, include: Optional[List[str]]) -> bool:
+    return include is None or any(fnmatch(file_path, p) for p in include)
+
+
+def _blob_sha(raw: bytes) -> str:
+    # Same sha git assigns to the blob, so archive files share the blob cache keys
+    return hashlib.sha1(b"blob %d\0" % len(raw) + raw).hexdigest()
+
+
+def _decode(raw: bytes) -> str:
+    try:
+        return raw.decode("utf-8")
+    except UnicodeDecodeError:
+        # Binary files
+        return "..."
 
 
 def get_last_commits(n: int, repo: str):
@@ -155,12 +337,10 @@ def create_pr(
 
 
 def get_review_comments(pr_number: int, repo: str) -> List[GithubComment]:
-    response = requests.get(
+    comments = _get_comments(
         f"https://api.github.com/repos/lgaleana/{repo}/pulls/{pr_number}/comments",
-        headers=HEADERS,
+        cache_path=f"{COMMENTS_DIR}/{repo}/{pr_number}/review.json",
     )
-    response.raise_for_status()
-    response = response.json()
     return [
         ReviewComment(
             id=c["id"],
@@ -168,21 +348,20 @@ def get_review_comments(pr_number: int, repo: str) -> List[GithubComment]:
             body=c["body"],
             created_at=datetime.strptime(c["created_at"], "%Y-%m-%dT%H:%M:%SZ"),
             html_url=c["html_url"],
+            path=c["path"],
             line=c["line"] or c["original_line"],
             diff_hunk=c["diff_hunk"],
             node_id=c["node_id"],
         )
-        for c in response
+        for c in comments
     ]
 
 
 def get_issue_comments(pr_number: int, repo: str) -> List[GithubComment]:
-    response = requests.get(
+    comments = _get_comments(
         f"https://api.github.com/repos/lgaleana/{repo}/issues/{pr_number}/comments",
-        headers=HEADERS,
+        cache_path=f"{COMMENTS_DIR}/{repo}/{pr_number}/issue.json",
     )
-    response.raise_for_status()
-    response = response.json()
     return [
         GithubComment(
             id=c["id"],
@@ -192,23 +371,68 @@ def get_issue_comments(pr_number: int, repo: str) -> List[GithubComment]:
             html_url=c["html_url"],
             node_id=c["node_id"],
         )
-        for c in response
+        for c in comments
     ]
 
 
 def get_comments(
-    pr_number: int, username: str, skip_ids: List[int], repo: str
+    pr_number: int, username: str, skip_ids: Collection[int], repo: str
 ) -> List[Union[ReviewComment, GithubComment]]:
-    review_comments = get_review_comments(pr_number, repo)
-    issue_comments = get_issue_comments(pr_number, repo)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        review_comments = executor.submit(get_review_comments, pr_number, repo)
+        issue_comments = executor.submit(get_issue_comments, pr_number, repo)
+        comments = review_comments.result() + issue_comments.result()
 
+    skip_ids = set(skip_ids)
     all_comments = []
-    for comment in sorted(review_comments + issue_comments, key=lambda c: c.created_at):
+    for comment in sorted(comments, key=lambda c: c.created_at):
         if comment.author != username and comment.id not in skip_ids:
             all_comments.append(comment)
     return all_comments
 
 
+def _get_comments(url: str, cache_path: str) -> List[Dict[str, Any]]:
+    # Only comments updated since the last poll are fetched and merged into the
+    # cached ones. Polls with nothing new get a 304, which is free of rate limit.
+    cache: Dict[str, Any] = {"since": None, "etag": None, "comments": {}}
+    if os.path.exists(cache_path):
+        with open(cache_path, "r") as f:
+            cache = json.load(f)
+
+    params: Dict[str, Any] = {"per_page": PER_PAGE}
+    if cache["since"]:
+        params["since"] = cache["since"]
+    headers = {"If-None-Match": cache["etag"]} if cache["etag"] else {}
+    response = session.get(url, params=params, headers=headers)
+    if response.status_code == 304:
+        return list(cache["comments"].values())
+    response.raise_for_status()
+
+    etag = response.headers.get("ETag")
+    comments = cache["comments"]
+    while True:
+        for c in response.json():
+            comments[str(c["id"])] = c
+        if "next" not in response.links:
+            break
+        response = session.get(response.links["next"]["url"])
+        response.raise_for_status()
+
+    # The ETag only matches later polls with the same `since`
+    since = max((c["updated_at"] for c in comments.values()), default=None)
+    cache = {
+        "since": since,
+        "etag": etag if since == cache["since"] else None,
+        "comments": comments,
+    }
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(cache, f)
+    os.replace(tmp_path, cache_path)
+    return list(comments.values())
+
+
 def reply_to_comment(
     pr_number: int, comment_id: int, reply: str, repo: str
 ) -> ReviewComment:
@@ -225,6 +449,7 @@ def reply_to_comment(
         body=c["body"],
         created_at=datetime.strptime(c["created_at"], "%Y-%m-%dT%H:%M:%SZ"),
         html_url=c["html_url"],
+        path=c["path"],
         line=c["line"],
         diff_hunk=c["diff_hunk"],
         node_id=c["node_id"],
@@ -0,0 +1,61 @@
+import re
+import xml.etree.ElementTree as ET
+from typing import List
+
+from pydantic import BaseModel
+
+
+MAX_FAILURES = 10
+MAX_TRACEBACK_LINES = 30
+
+# `tests/test_app.py:12: AssertionError` in pytest's long tracebacks
+LOCATION = re.compile(r"^[\w./-]+\.py:\d+: ")
+
+
+class TestFailure(BaseModel):
+    test_id: str
+    message: str
+    traceback: str
+
+    def __str__(self) -> str:
+        return f"{self.test_id}\n{self.message}\n```\n{self.traceback}\n```"
+
+
+def parse(report: str) -> List[TestFailure]:
+    try:
+        root = ET.fromstring(report)
+    except ET.ParseError:
+        return []
+
+    failures = []
+    for case in root.iter("testcase"):
+        for result in case:
+            if result.tag not in ["failure", "error"]:
+                continue
+            # Collection errors have no class name
+            classname = case.get("classname")
+            name = case.get("name", "")
+            failures.append(
+                TestFailure(
+                    test_id=f"{classname}::{name}" if classname else name,
+                    message=result.get("message", result.tag),
+                    traceback=trim(result.text or ""),
+                )
+            )
+    return failures
+
+
+def summarize(failures: List[TestFailure]) -> str:
+    summary = "\n\n".join(str(f) for f in failures[:MAX_FAILURES])
+    if len(failures) > MAX_FAILURES:
+        summary += f"\n\n... and {len(failures) - MAX_FAILURES} more failures"
+    return summary
+
+
+def trim(traceback: str) -> str:
+    # The failing lines, the errors and where they happened. Not the whole source.
+    lines = traceback.splitlines()
+    key_lines = [
+        line for line in lines if line.startswith((">", "E ")) or LOCATION.match(line)
+    ]
+    return "\n".join((key_lines or lines)[-MAX_TRACEBACK_LINES:])
@@ -1,18 +1,30 @@
+import gzip
+import hashlib
+import json
 import os
-import time
 from typing import List
 
 from agents.coder import File
 
 
 DIFFS_DIR = "gcpal-docker/diffs"
+ARCHIVE_DIFFS = os.environ.get("ARCHIVE_DIFFS", "False") == "True"
 
 
-def create_files(files: List[File], root_path: str) -> None:
+def archive_files(files: List[File], name: str) -> None:
+    # Contents are stored once per hash, manifests map paths to hashes
+    manifest = {}
     for file in files:
-        full_path = f"{root_path}/{file.path}"
-        intermediate_dirs, _ = os.path.split(full_path)
-        if intermediate_dirs:
-            os.makedirs(intermediate_dirs, exist_ok=True)
-        with open(full_path, "w") as f:
-            f.write(file.content)
+        content = file.content.encode("utf-8")
+        sha = hashlib.sha256(content).hexdigest()
+        object_path = f"{DIFFS_DIR}/objects/{sha[:2]}/{sha}.gz"
+        if not os.path.exists(object_path):
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            with gzip.open(object_path, "wb") as f:
+                f.write(content)
+        manifest[file.path] = sha
+
+    manifest_path = f"{DIFFS_DIR}/{name}.json"
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=4)
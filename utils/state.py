@@ -1,7 +1,9 @@
 import json
+import threading
+from collections import deque
 from copy import deepcopy
 from pydantic import BaseModel
-from typing import Any, Dict, List, Literal, Optional
+from typing import Any, Deque, Dict, List, Literal, Optional
 
 from ai.llm import RawTool
 from tools.github import PullRequest
@@ -63,20 +65,53 @@ class CommandStatus:
 class Command(BaseModel):
     command: str
     output: List[str] = []
+    # Lines left out of output, and where they were
+    omitted: int = 0
+    omitted_at: int = 0
+    # Indexes of the output lines that came from stderr
+    stderr_lines: List[int] = []
     status: Literal[
         CommandStatus.SUCCESS,  # type: ignore
         CommandStatus.ERROR,  # type: ignore
         CommandStatus.TIMEOUT,  # type: ignore
     ]
+    exit_code: Optional[int] = None
+    duration: float = 0
+    stdout_bytes: int = 0
+    stderr_bytes: int = 0
+    log_path: Optional[str] = None
 
     def output_str(self, max_len: int = -1) -> str:
-        output_str = "\n".join(self.output)
-        if max_len >= 0 and max_len < len(output_str):
-            output_str = f"Output too long: ... {output_str[-max_len:]}"
+        lines = self.output
+        if self.omitted:
+            lines = (
+                lines[: self.omitted_at]
+                + [f"... {self.omitted} lines omitted ..."]
+                + lines[self.omitted_at :]
+            )
+        if max_len < 0:
+            return "\n".join(lines)
+
+        # Only join the lines that reach into the last max_len characters
+        tail: List[str] = []
+        size = -1
+        for line in reversed(lines):
+            tail.append(line)
+            size += len(line) + 1
+            if size > max_len:
+                break
+        output_str = "\n".join(reversed(tail))
+        if size > max_len:
+            start = len(output_str) - max_len
+            output_str = f"Output too long: ... {output_str[start:]}"
         return output_str
 
 
-command_list = []
+MAX_COMMANDS = 500
+
+# Appended to from the docker loop thread
+command_list: Deque[Command] = deque(maxlen=MAX_COMMANDS)
+command_lock = threading.Lock()
 
 
 class State(BaseModel):
@@ -108,7 +143,9 @@ class State(BaseModel):
 
     def _persist(self, name: str) -> None:
         payload = self.model_dump()
-        payload["commands"] = [c.json() for c in command_list]
+        with command_lock:
+            commands = list(command_list)
+        payload["commands"] = [c.json() for c in commands]
         with open(f"db/{self.agent}/{name}.json", "w") as file:
             json.dump(payload, file, indent=4)
 
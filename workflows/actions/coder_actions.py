@@ -1,14 +1,31 @@
+import os
+import threading
 import time
-from typing import Union
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Union
 
-from agents.coder import WritePRParams
+from agents.coder import File, WritePRParams
 from agents.contributor import AmendPRParams
-from tools import github
-from tools.docker import container
-from tools.docker.commands import DockerRunner
-from tools.tmp import create_files, DIFFS_DIR
+from ai.graph import get_graph
+from ai.json_stream import Path
+from tools import github, junit
+from tools.docker import container, deps
+from tools.docker.commands import DockerRunner, Timeout
+from tools.tmp import archive_files, ARCHIVE_DIFFS
 from utils.io import print_system
-from utils.state import CommandStatus
+from utils.state import Command, CommandStatus
+
+
+# pytest exits with 5 when it collects no tests
+PYTEST_NO_TESTS = 5
+
+# Test runs can be silent for long stretches
+TESTS_TIMEOUT = Timeout(inactivity=None, total=30 * 60, heartbeat=30)
+PUSH_TIMEOUT = Timeout(inactivity=60)
+
+JUNIT_REPORT = "/tmp/gcpal-junit.xml"
+# Shards the suite across cores when the repo has pytest-xdist
+PARALLEL = "$(python3 -c 'import xdist' 2> /dev/null && printf -- '-n auto')"
 
 
 class PRError(Exception):
@@ -16,7 +33,107 @@ class PRError(Exception):
 
 
 class TestsError(PRError):
-    pass
+    def __init__(
+        self, message: str, failures: Optional[List[junit.TestFailure]] = None
+    ):
+        super().__init__(message)
+        self.failures = failures or []
+
+
+class FileStream:
+    def __init__(
+        self,
+        state_name: str,
+        docker: DockerRunner,
+        repo: str,
+        branch: Optional[str] = None,
+    ):
+        self.archive_name = f"{state_name}/{time.time()}"
+        self.repo_path = f"/home/{repo}"
+        # Each attempt runs in its own worktree. Failed ones are dropped with it.
+        self.container_path = f"/home/{repo}.worktrees/{time.time_ns()}"
+        self.docker = docker
+        # New branches start from main, existing ones from their remote head
+        self.branch = branch
+        self.worktree: Optional[Future] = None
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self.copies: List[Future] = []
+        self.staged: Dict[str, File] = {}
+        self.pending: List[File] = []
+        self.lock = threading.Lock()
+        self.pushed = False
+        self.closed = False
+
+    def on_item(self, path: Path, value: Any) -> None:
+        if len(path) == 2 and path[0] in ["files", "test_files"]:
+            self.stage(File.model_validate(value))
+
+    def stage(self, file: File) -> None:
+        self._open()
+        assert self.executor
+        self.staged[file.path] = file
+        with self.lock:
+            self.pending.append(file)
+        self.copies.append(self.executor.submit(self._flush))
+
+    def finish(self, files: List[File]) -> Command:
+        for file in files:
+            if self.staged.get(file.path) != file:
+                self.stage(file)
+        self._open()
+        assert self.executor and self.worktree
+
+        self.executor.shutdown(wait=True)
+        worktree = self.worktree.result()
+        if worktree.status != CommandStatus.SUCCESS:
+            return worktree
+        for copy in self.copies:
+            copy.result()  # Raise copy errors here
+        if ARCHIVE_DIFFS:
+            archive_files(list(self.staged.values()), name=self.archive_name)
+        return worktree
+
+    def close(self) -> None:
+        if self.worktree is None or self.closed:
+            return
+        self.closed = True
+        self.docker.execute(
+            [
+                f"cd {self.repo_path}",
+                f"git worktree remove --force {self.container_path}",
+            ],
+            stop_on_error=False,
+        )
+
+    def _open(self) -> None:
+        if self.executor is not None:
+            return
+        # A single worker keeps the worktree creation and copies in order
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        if self.branch:
+            command = (
+                f"git fetch origin {self.branch} && git worktree add"
+                f" -B {self.branch} {self.container_path} FETCH_HEAD"
+            )
+        else:
+            command = f"git worktree add --detach {self.container_path} main"
+        self.worktree = self.executor.submit(
+            self.docker.execute_one, command, timeout=PUSH_TIMEOUT
+        )
+
+    def _flush(self) -> None:
+        assert self.worktree
+        if self.worktree.result().status != CommandStatus.SUCCESS:
+            return
+        # Files that arrived during the previous transfer go out in one batch
+        with self.lock:
+            files, self.pending = self.pending, []
+        if files:
+            container.copy_files(
+                files,
+                container_path=self.container_path,
+                container=self.docker.container,
+            )
 
 
 def create_or_edit_pr(
@@ -24,31 +141,36 @@ def create_or_edit_pr(
     state_name: str,
     docker: DockerRunner,
     repo: str,
+    stream: Optional[FileStream] = None,
+    repo_files: Optional[List[Optional[github.GithubFile]]] = None,
 ) -> github.PullRequest:
-    # Create files locally first
-    print_system("Copying files to container...")
-    root_path = f"{DIFFS_DIR}/{state_name}/{time.time()}"
-    create_files(tool.files + tool.test_files, root_path=root_path)
-
-    # 1. Move to branch
     if isinstance(tool, WritePRParams):
         git_branch = tool.git_branch
-        branch = docker.execute_one(f"git checkout -b {git_branch}")
     else:
         git_branch = tool.original.head
-        branch = docker.execute_one(f"git checkout {git_branch}")
-    if branch.status == CommandStatus.ERROR or "fatal:" in branch.output_str():
+    if stream is None:
+        stream = FileStream(
+            state_name,
+            docker,
+            repo,
+            branch=None if isinstance(tool, WritePRParams) else git_branch,
+        )
+
+    # 1. Copy the files that haven't been streamed to the container yet
+    print_system("Copying files to container...")
+    worktree = stream.finish(tool.files + tool.test_files)
+    if worktree.status != CommandStatus.SUCCESS:
         raise PRError(
-            f"Error running :: `{branch.command}`. Error :: {branch.output_str()}"
+            f"Error running :: `{worktree.command}`. Error :: {worktree.output_str()}"
         )
 
-    # 2. Copy files to docker container
-    container.copy_files(
-        files=tool.files + tool.test_files,
-        root=root_path,
-        container_path=f"/home/{repo}",
-        docker=docker,
-    )
+    # 2. Move to the attempt's worktree and branch
+    branch_commands = [f"cd {stream.container_path}"]
+    if isinstance(tool, WritePRParams):
+        branch_commands.append(f"git checkout -b {git_branch}")
+    for c in docker.execute(branch_commands):
+        if c.status == CommandStatus.ERROR:
+            raise PRError(f"Error running :: `{c.command}`. Error :: {c.output_str()}")
     docker.execute_one("git status")
 
     # 3. Delete files
@@ -57,18 +179,26 @@ def create_or_edit_pr(
         raise PRError(f"Error running :: `{rm.command}`. Error :: {rm.output_str()}")
 
     # 3. Install new requirements
-    pip = docker.execute_one("python3 -m pip install -r requirements.txt")
+    pip = deps.sync(docker)
     if pip.status == CommandStatus.ERROR:
         raise PRError(f"Error running :: `{pip.command}`. Error :: {pip.output_str()}")
 
-    # 5. Run tests
-    pytest = docker.execute_one("python3 -m pytest")
-    if (
-        pytest.status == CommandStatus.ERROR
-        or "= ERRORS =" in pytest.output_str()
-        or "= FAILURES =" in pytest.output_str()
-    ):
-        raise TestsError(f"The tests failed :: {pytest.output_str()}")
+    # 5. Run the tests affected by the change first, then the whole suite
+    report = f"--junitxml={JUNIT_REPORT}"
+    test_commands = [f"python3 -m pytest {PARALLEL} {report}"]
+    if repo_files is not None:
+        affected = affected_tests(tool, repo_files)
+        if affected:
+            test_commands.insert(
+                0, f"python3 -m pytest -x {report} {' '.join(affected)}"
+            )
+    for command in test_commands:
+        pytest = docker.execute_one(command, timeout=TESTS_TIMEOUT)
+        if (
+            pytest.status != CommandStatus.SUCCESS
+            and pytest.exit_code != PYTEST_NO_TESTS
+        ):
+            raise tests_error(pytest, docker)
 
     # 6. Create commit and push
     commit_commands = docker.execute(
@@ -76,11 +206,13 @@ def create_or_edit_pr(
             "git add .",
             f'git commit -m "{tool.title}"',
             f"git push origin {git_branch}",
-        ]
+        ],
+        timeout=PUSH_TIMEOUT,
     )
     for c in commit_commands:
         if c.status == CommandStatus.ERROR:
             raise PRError(f"Error running :: `{c.command}`. Error :: {c.output_str()}")
+    stream.pushed = True
 
     if isinstance(tool, WritePRParams):
         # 7. Create PR
@@ -96,28 +228,71 @@ def create_or_edit_pr(
         pr = tool.original
 
     pr.commits.append(docker.execute_one("git rev-parse HEAD").output_str())
+    # 8. Leave the worktree. The branch keeps the commit.
+    stream.close()
     return pr
 
 
-def rollback(branch: str, docker: DockerRunner) -> None:
-    print_system()
-    print_system("!!!!! Rolling back...")
-    docker.execute(
+def tests_error(pytest: Command, docker: DockerRunner) -> TestsError:
+    xml = container.read_file(JUNIT_REPORT, container=docker.container, remove=True)
+    failures = junit.parse(xml) if xml else []
+    if not failures:
+        # pytest didn't get to report, e.g. a usage or internal error
+        return TestsError(f"The tests failed :: {pytest.output_str()}")
+    return TestsError(
+        f"The tests failed :: {junit.summarize(failures)}", failures=failures
+    )
+
+
+def affected_tests(
+    tool: Union[WritePRParams, AmendPRParams],
+    repo_files: List[Optional[github.GithubFile]],
+) -> List[str]:
+    changed = [f.path for f in tool.files + tool.test_files] + tool.deleted_files
+    if any(os.path.basename(path) == "conftest.py" for path in changed):
+        # Fixtures can affect any test
+        return []
+
+    # Deleted files stay in the graph, so their importers are selected
+    graph = get_graph(repo_files).with_files(
         [
-            f"git checkout {branch}",
-            "python3 -m pip uninstall -r requirements.txt -y",  # roll back packages
-            "git restore .",  # roll back files
-            "git clean -fd",  # roll back files
-            "git checkout main",  # roll back branch
-            f"git branch -D {branch}",  # roll back branch
-            f"git push origin --delete {branch}",  # rollb back github branch
-            "python3 -m pip install -r requirements.txt",  # roll back packages
+            github.GithubFile(path=f.path, content=f.content)
+            for f in tool.files + tool.test_files
         ]
     )
+    return sorted(
+        path
+        for path in graph.dependents(changed)
+        if path not in tool.deleted_files and _is_test(path)
+    )
+
+
+def _is_test(path: str) -> bool:
+    # pytest's default python_files
+    name = os.path.basename(path)
+    return name.startswith("test_") or name.endswith("_test.py")
+
+
+def rollback(branch: str, docker: DockerRunner, stream: FileStream) -> None:
+    print_system()
+    print_system("!!!!! Rolling back...")
+    stream.close()  # roll back files
+    docker.execute_one(f"git branch -D {branch}")  # roll back branch
+    if stream.pushed:
+        # roll back github branch
+        docker.execute_one(f"git push origin --delete {branch}", timeout=PUSH_TIMEOUT)
+    deps.sync(docker)  # roll back packages
     print_system("Rollback successful...")
 
 
 def create_pr(
-    tool: WritePRParams, state_name: str, docker: DockerRunner, repo: str
+    tool: WritePRParams,
+    state_name: str,
+    docker: DockerRunner,
+    repo: str,
+    stream: Optional[FileStream] = None,
+    repo_files: Optional[List[Optional[github.GithubFile]]] = None,
 ) -> github.PullRequest:
-    return create_or_edit_pr(tool, state_name, docker, repo)
+    return create_or_edit_pr(
+        tool, state_name, docker, repo, stream=stream, repo_files=repo_files
+    )
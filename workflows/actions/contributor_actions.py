@@ -1,43 +1,40 @@
+from typing import List, Optional
+
 from agents.contributor import AmendPRParams
+from tools.docker import deps
 from tools.docker.commands import DockerRunner
-from tools.github import PullRequest
+from tools.github import GithubFile, PullRequest
 from utils.io import print_system
-from workflows.actions.coder_actions import create_or_edit_pr
+from workflows.actions.coder_actions import (
+    create_or_edit_pr,
+    FileStream,
+    PUSH_TIMEOUT,
+)
 
 
-def rollback(pr: PullRequest, docker: DockerRunner) -> None:
+def rollback(pr: PullRequest, docker: DockerRunner, stream: FileStream) -> None:
     print_system()
     print_system("!!!!! Rolling back...")
-    docker.execute(
-        [
-            f"git checkout {pr.head}",
-            "python3 -m pip uninstall -r requirements.txt -y",  # roll back packages
-            "git restore .",  # roll back files
-            "git clean -fd",  # roll back files
-        ]
-    )
-    rev = docker.execute_one("git rev-parse HEAD").output_str()
-    print(rev)
-    print(pr.commits)
-    breakpoint()
-    if rev != pr.commits[-1]:
-        # We need to revert the last commit
-        docker.execute(
-            [
-                "git reset --hard HEAD~1",
-                f"git push origin {pr.head} -f",  # roll back amend
-            ]
+    stream.close()  # roll back files
+    # roll back amend
+    docker.execute_one(f"git branch -f {pr.head} {pr.commits[-1]}")
+    if stream.pushed:
+        docker.execute_one(
+            f"git push origin {pr.commits[-1]}:refs/heads/{pr.head} -f",
+            timeout=PUSH_TIMEOUT,
         )
-    docker.execute(
-        [
-            "git checkout main",
-            "python3 -m pip install -r requirements.txt",  # roll back packages
-        ]
-    )
-    print_system("Rollback successful...")  # roll back commit
+    deps.sync(docker)  # roll back packages
+    print_system("Rollback successful...")
 
 
 def edit_pr(
-    tool: AmendPRParams, state_name: str, docker: DockerRunner, repo: str
+    tool: AmendPRParams,
+    state_name: str,
+    docker: DockerRunner,
+    repo: str,
+    stream: Optional[FileStream] = None,
+    repo_files: Optional[List[Optional[GithubFile]]] = None,
 ) -> PullRequest:
-    return create_or_edit_pr(tool, state_name, docker, repo)
+    return create_or_edit_pr(
+        tool, state_name, docker, repo, stream=stream, repo_files=repo_files
+    )
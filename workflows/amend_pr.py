@@ -10,10 +10,10 @@ from ai_tools import sumamrize_test_failure, there_is_followup
 from agents import contributor
 from workflows.write_pr import AGENT as CODER_AGENT, TOOL_FAIL_MSG, merge_prs
 from tools import github
-from tools.docker.commands import DockerRunner
+from tools.docker import pool
 from utils.io import print_system
 from utils.state import Conversation, State
-from workflows.actions.coder_actions import TestsError
+from workflows.actions.coder_actions import FileStream, TestsError
 from workflows.actions.contributor_actions import edit_pr, rollback
 
 
@@ -39,88 +39,93 @@ def run(context_state: State, repo: str, state: State) -> None:
         return
     comment = comments[0]
 
-    codebase = github.get_repo_files(repo=repo)
-
-    docker = DockerRunner(
-        startup_commands=[
-            f"cd /home/{repo}",
-            "pwd",
-            "source venv/bin/activate",
-            "git checkout main",
-            "git pull origin main --rebase",
-        ]
-    )
+    # The PR branch includes the commits the agent has already pushed
+    snapshot = github.get_snapshot(repo=repo, branch=pr.head)
 
     conversation = state.conversation
     conversation.add_user(f"You have a new comment in the PR:\n{comment}")
     print_system(comment)
 
-    while True:
-        ai_action = contributor.next_action(
-            conversation_context=context_state.conversation,
-            conversation=conversation,
-            repo_files=codebase,
-        )
-        if isinstance(ai_action, str):
-            conversation.add_assistant(ai_action)
-            # user_message = user_input()
-            # if user_message == "y":
-            assistant_comment = github.reply_to_comment(
-                pr.number,
-                comment.id,
-                reply=ai_action,
-                repo=repo,
+    with pool.lease(repo) as docker:
+        while True:
+            snapshot = github.refresh_snapshot(snapshot)
+            codebase = snapshot.files
+            # Files are copied to the PR branch as soon as they are generated
+            stream = FileStream(state.name, docker, repo, branch=pr.head)
+            ai_action = contributor.next_action(
+                conversation_context=context_state.conversation,
+                conversation=conversation,
+                repo_files=codebase,
+                comment=str(comment),
+                on_item=stream.on_item,
             )
-            print_system(f"Comment saved :: {assistant_comment}")
-            conversation.add_system("Comment saved.")
-
-            if not there_is_followup(assistant_comment.body):
-                # There are cases where the agent replies, but
-                # the next action should immediately be to amend the PR
-                break
-            # else:
-            #     print_system("Comment not saved.")
-            #     break
-        else:
-            if len(ai_action.arguments) != 1:
-                print(ai_action.arguments)
-                breakpoint()
-            arguments = merge_prs(ai_action.arguments)
-            tool = contributor.AmendPRParams(original=pr, **arguments.dict())
-            print_system(tool)
-            conversation.add_tool(tool=ai_action)
-
-            try:
-                state.pr = edit_pr(tool, state.name, docker, repo=repo)
-                conversation.add_tool_response(
-                    tool_id=ai_action.id,
-                    message=(f"PR amended successfully :: {state.pr}"),
+            if isinstance(ai_action, str):
+                conversation.add_assistant(ai_action)
+                # user_message = user_input()
+                # if user_message == "y":
+                assistant_comment = github.reply_to_comment(
+                    pr.number,
+                    comment.id,
+                    reply=ai_action,
+                    repo=repo,
                 )
-                print_system(state.pr)
-                break
-            except Exception as e:
-                print_system()
-                print_system(f"!!!!! ERROR\n: {e}")
-                traceback.print_tb(e.__traceback__)
-                print_system()
-
-                rollback(pr, docker)
-
-                if isinstance(e, TestsError):
-                    conversation.remove_last_failed_tool(TOOL_FAIL_MSG)
-                    conversation.add_tool_response(
-                        tool_id=ai_action.id,
-                        message=sumamrize_test_failure(
-                            pr=tool, failure_msg=str(e), repo_files=codebase
-                        ),
+                print_system(f"Comment saved :: {assistant_comment}")
+                conversation.add_system("Comment saved.")
+
+                if not there_is_followup(assistant_comment.body):
+                    # There are cases where the agent replies, but
+                    # the next action should immediately be to amend the PR
+                    break
+                # else:
+                #     print_system("Comment not saved.")
+                #     break
+            else:
+                if len(ai_action.arguments) != 1:
+                    print(ai_action.arguments)
+                    breakpoint()
+                arguments = merge_prs(ai_action.arguments)
+                tool = contributor.AmendPRParams(original=pr, **arguments)
+                print_system(tool)
+                conversation.add_tool(tool=ai_action)
+
+                try:
+                    state.pr = edit_pr(
+                        tool,
+                        state.name,
+                        docker,
+                        repo=repo,
+                        stream=stream,
+                        repo_files=codebase,
                     )
-                    conversation.add_user(TOOL_FAIL_MSG)
-                else:
                     conversation.add_tool_response(
                         tool_id=ai_action.id,
-                        message=str(e),
+                        message=(f"PR amended successfully :: {state.pr}"),
                     )
-        state.persist()
+                    print_system(state.pr)
+                    break
+                except Exception as e:
+                    print_system()
+                    print_system(f"!!!!! ERROR\n: {e}")
+                    traceback.print_tb(e.__traceback__)
+                    print_system()
+
+                    rollback(pr, docker, stream)
+
+                    if isinstance(e, TestsError):
+                        conversation.remove_last_failed_tool(TOOL_FAIL_MSG)
+                        conversation.add_tool_response(
+                            tool_id=ai_action.id,
+                            message=sumamrize_test_failure(
+                                pr=tool, failure_msg=str(e), repo_files=codebase
+                            ),
+                        )
+                        conversation.add_user(TOOL_FAIL_MSG)
+                    else:
+                        conversation.add_tool_response(
+                            tool_id=ai_action.id,
+                            message=str(e),
+                        )
+            state.persist()
 
     conversation.remove_last_failed_tool(TOOL_FAIL_MSG)
     acted_comments.append(comment.id)
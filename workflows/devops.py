@@ -16,7 +16,6 @@ AGENT = "devops"
 
 
 def run(state: State, repo: str) -> None:
-    codebase = github.get_repo_files(repo=repo)
     startup_commands = [
         f"cd /home/{repo}",
         "source venv/bin/activate",
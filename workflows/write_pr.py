@@ -1,6 +1,8 @@
 import argparse
+import multiprocessing
 import time
 import traceback
+from concurrent.futures import ProcessPoolExecutor
 from typing import Any, Dict, List
 
 from dotenv import load_dotenv
@@ -11,10 +13,15 @@ from agents import coder
 from ai_tools import sumamrize_test_failure
 from tools import github
 from tools import jira
-from tools.docker.commands import DockerRunner
+from tools.docker import pool
 from utils.io import print_system
 from utils.state import Conversation, State
-from workflows.actions.coder_actions import create_pr, rollback, TestsError
+from workflows.actions.coder_actions import (
+    create_pr,
+    FileStream,
+    rollback,
+    TestsError,
+)
 
 
 AGENT = "coder"
@@ -24,86 +31,93 @@ TOOL_FAIL_MSG = "The PR has been deleted. Fix the tests and re-create the PR. Go
 
 def run(state: State, repo: str, ticket_key: str) -> None:
     tickets = jira.get_all_issues(ticket_key.split("-")[0])
-    codebase = github.get_repo_files(repo=repo)
+    snapshot = github.get_snapshot(repo=repo)
     active_ticket = jira.find_issue(tickets, ticket_key)
     assert active_ticket
     assert active_ticket.type_ in [
         "Subtask"
     ], "Tickets must be subtasks, found :: {active_ticket.type_}"
 
-    docker = DockerRunner(
-        startup_commands=[
-            f"cd /home/{repo}",
-            "pwd",
-            "source venv/bin/activate",
-            "git checkout main",
-            "git pull origin main --rebase",
-        ]
-    )
-
     conversation = state.conversation
 
     # code_suggestion = suggest_code(active_ticket, codebase)
 
-    while True:
-        ai_action = coder.write_pr(active_ticket, conversation, codebase)
-        if isinstance(ai_action, str):
-            conversation.add_assistant(ai_action)
-            # user_message = user_input()
-            # conversation.add_user(user_message)
-        else:
-            tool = merge_prs(ai_action.arguments)
-            print_system(tool)
-            conversation.add_tool(tool=ai_action)
-
-            try:
-                state.pr = create_pr(tool, state.name, docker, repo=repo)
-                conversation.add_tool_response(
-                    tool_id=ai_action.id,
-                    message=(f"PR created successfully :: {state.pr}"),
+    # Each ticket gets its own container, so several can run in parallel
+    with pool.lease(repo) as docker:
+        while True:
+            snapshot = github.refresh_snapshot(snapshot)
+            codebase = snapshot.files
+            # Files are copied to the container as soon as they are generated
+            stream = FileStream(state.name, docker, repo)
+            ai_action = coder.write_pr(
+                active_ticket, conversation, codebase, on_item=stream.on_item
+            )
+            if isinstance(ai_action, str):
+                conversation.add_assistant(ai_action)
+                # user_message = user_input()
+                # conversation.add_user(user_message)
+            else:
+                tool = coder.WritePRParams.model_validate(
+                    merge_prs(ai_action.arguments)
                 )
-                print_system(state.pr)
-                break
-            except Exception as e:
-                print_system()
-                print_system(f"!!!!! ERROR\n: {e}")
-                traceback.print_tb(e.__traceback__)
-                print_system()
-
-                rollback(tool.git_branch, docker)
-                if state.pr:
-                    state.pr.commits.pop()
-
-                if isinstance(e, TestsError):
-                    conversation.remove_last_failed_tool(TOOL_FAIL_MSG)
-                    conversation.add_tool_response(
-                        tool_id=ai_action.id,
-                        message=sumamrize_test_failure(
-                            pr=tool, failure_msg=str(e), repo_files=codebase
-                        ),
+                print_system(tool)
+                conversation.add_tool(tool=ai_action)
+
+                try:
+                    state.pr = create_pr(
+                        tool,
+                        state.name,
+                        docker,
+                        repo=repo,
+                        stream=stream,
+                        repo_files=codebase,
                     )
-                    conversation.add_user(TOOL_FAIL_MSG)
-                else:
                     conversation.add_tool_response(
                         tool_id=ai_action.id,
-                        message=str(e),
+                        message=(f"PR created successfully :: {state.pr}"),
                     )
-        state.persist()
+                    print_system(state.pr)
+                    break
+                except Exception as e:
+                    print_system()
+                    print_system(f"!!!!! ERROR\n: {e}")
+                    traceback.print_tb(e.__traceback__)
+                    print_system()
+
+                    rollback(tool.git_branch, docker, stream)
+                    if state.pr:
+                        state.pr.commits.pop()
+
+                    if isinstance(e, TestsError):
+                        conversation.remove_last_failed_tool(TOOL_FAIL_MSG)
+                        conversation.add_tool_response(
+                            tool_id=ai_action.id,
+                            message=sumamrize_test_failure(
+                                pr=tool, failure_msg=str(e), repo_files=codebase
+                            ),
+                        )
+                        conversation.add_user(TOOL_FAIL_MSG)
+                    else:
+                        conversation.add_tool_response(
+                            tool_id=ai_action.id,
+                            message=str(e),
+                        )
+            state.persist()
 
     conversation.remove_last_failed_tool(TOOL_FAIL_MSG)
     state.final_persist(ticket_key)
 
 
-def merge_prs(prs: List[Dict[str, Any]], cls):
+def merge_prs(prs: List[Dict[str, Any]]) -> Dict[str, Any]:
     seen_paths = set()
     seen_test_paths = set()
     seen_deleted_paths = set()
     canon_pr = None
 
-    def update_files(files: List[coder.File], canon_files: List[coder.File], seen):
+    def update_files(files: List[Dict], canon_files: List[Dict], seen):
         for file in files:
-            assert file.path not in seen
-            seen.add(file.path)
+            assert file["path"] not in seen
+            seen.add(file["path"])
             canon_files.append(file)
 
     for pr in prs:
@@ -127,17 +141,38 @@ def merge_prs(prs: List[Dict[str, Any]], cls):
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("ticket", type=str)
+    parser.add_argument("tickets", type=str, nargs="+")
     parser.add_argument("repo", type=str)
     parser.add_argument("--name", type=str, default=None)
     args = parser.parse_args()
+    assert not args.name or len(args.tickets) == 1, "--name needs a single ticket"
 
     states_dir = f"db/{AGENT}/"
-    if args.name:
-        state = State.load(args.name, AGENT)
+    states = []
+    for ticket in args.tickets:
+        if args.name:
+            state = State.load(args.name, AGENT)
+        else:
+            state = State(
+                name=str(time.time()),
+                agent=AGENT,
+                conversation=Conversation(),
+                pr=None,
+            )
+        states.append(state)
+
+    if len(args.tickets) == 1:
+        run(states[0], repo=args.repo, ticket_key=args.tickets[0])
     else:
-        state = State(
-            name=str(time.time()), agent=AGENT, conversation=Conversation(), pr=None
-        )
-
-    run(state, repo=args.repo, ticket_key=args.ticket)
+        # A process per ticket, so command history and caches aren't shared. Tickets
+        # wait for a free container when there are more tickets than containers.
+        with ProcessPoolExecutor(
+            max_workers=len(args.tickets),
+            mp_context=multiprocessing.get_context("spawn"),
+        ) as executor:
+            futures = [
+                executor.submit(run, state, repo=args.repo, ticket_key=ticket)
+                for state, ticket in zip(states, args.tickets)
+            ]
+            for future in futures:
+                future.result()